@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Aggregation pipeline builder. Stages are composed from the same helpers as
+`find` queries, and results are read in batches, optionally hydrated into
+collection class. Usage:
+
+    aggregation = Order.objects.aggregation() \
+        .match(status='paid') \
+        .group('$user_id', total={'$sum': '$amount'}) \
+        .sort(Sorter(total=Sorter.DIRECTION_DESC)) \
+        .limit(100)
+    stream = aggregation.stream(model=UserTotal, allow_disk_use=True)
+    while True:
+        batch = yield motor.Op(stream.next_batch)
+        if not batch:
+            break
+        ...
+
+    totals = yield motor.Op(aggregation.all, model=UserTotal)
+'''
+
+import motor
+
+from bson.son import SON
+from pymongo import ReadPreference
+from tornado import gen
+
+from utils import Filter, Sorter, model_fields
+
+
+__all__ = ['Aggregation', ]
+
+
+class ResultCursor(object):
+    '''
+    Cursor-like wrapper of aggregation command cursor for drivers, which
+    don't support command cursors. Command is sent on first `fetch_next`,
+    first batch is read from its response and the rest is read with
+    `getMore` commands (MongoDB 3.2+), so result size isn't limited by
+    maximum document size. Commands are sent to primary, because
+    `getMore` must reach the server, which has the cursor.
+    '''
+
+    def __init__(self, db, command, batch_size=100):
+        self.db = db
+        self.command = command
+        self.batch_size = batch_size
+        self.documents = None
+        self.position = 0
+        self.cursor_id = 0
+        self.collection_name = command['aggregate']
+        self.alive = True
+
+    @property
+    def fetch_next(self):
+        return motor.Op(self._fetch_next)
+
+    def _run(self, command, callback):
+        self.db.command(command, read_preference=ReadPreference.PRIMARY,
+                        callback=callback)
+
+    @gen.engine
+    def _fetch_next(self, callback):
+        try:
+            if self.documents is None:
+                response = yield motor.Op(self._run, self.command)
+                self._read_batch(response, 'firstBatch')
+            while self.position >= len(self.documents) and self.cursor_id:
+                response = yield motor.Op(self._run, SON([
+                    ('getMore', self.cursor_id),
+                    ('collection', self.collection_name),
+                    ('batchSize', self.batch_size)]))
+                self._read_batch(response, 'nextBatch')
+        except Exception, e:
+            self.close()
+            callback(None, e)
+            return
+        callback(self.position < len(self.documents), None)
+
+    def _read_batch(self, response, name):
+        if 'cursor' not in response:  # inline result of old server
+            self.documents = response.get('result', [])
+            self.cursor_id = 0
+        else:
+            cursor = response['cursor']
+            self.documents = cursor.get(name, [])
+            self.cursor_id = cursor.get('id', 0)
+            # namespace is "<db>.<collection>"
+            if cursor.get('ns'):
+                self.collection_name = cursor['ns'].split('.', 1)[1]
+        self.position = 0
+        if not self.cursor_id and not self.documents:
+            self.alive = False
+
+    def next_object(self):
+        document = self.documents[self.position]
+        self.documents[self.position] = None  # release it for gc
+        self.position += 1
+        return document
+
+    def close(self, callback=None):
+        self.alive = False
+        self.documents = []
+        cursor_id, self.cursor_id = self.cursor_id, 0
+        if cursor_id:  # server cursor isn't exhausted
+            self._run(SON([('killCursors', self.collection_name),
+                           ('cursors', [cursor_id])]),
+                      callback=lambda result, error: None)
+        if callback is not None:
+            callback(None, None)
+
+
+# Motor 0.2+ returns command cursor from `aggregate`
+_COMMAND_CURSORS = motor.version_tuple >= (0, 2)
+
+
+class Aggregation(object):
+    '''
+    Builder of aggregation pipeline for manager collection. Every stage
+    method appends stage and returns aggregation itself.
+    '''
+
+    def __init__(self, manager, pipeline=None):
+        self.manager = manager
+        self.pipeline = list(pipeline or [])
+
+    def stage(self, operator, value):
+        self.pipeline.append({operator: value})
+        return self
+
+    def match(self, spec=None, **conditions):
+        '''
+        Accepts query spec, `Filter` or conditions as keyword arguments.
+        '''
+        if isinstance(spec, Filter):
+            spec = dict(spec.filter_params)
+        spec = dict(spec or {}, **conditions)
+        return self.stage('$match', spec)
+
+    def project(self, include=None, exclude=None, **expressions):
+        '''
+        Fields are given the same way as for `model_fields`, computed
+        fields as keyword arguments, e.g.:
+
+            aggregation.project('name,email', total={'$add': ['$a', '$b']})
+        '''
+        projection = model_fields(include, exclude)
+        projection.update(expressions)
+        return self.stage('$project', projection)
+
+    def group(self, key, **accumulators):
+        group = SON([('_id', key)])
+        group.update(accumulators)
+        return self.stage('$group', group)
+
+    def sort(self, sorter=None, **params):
+        '''
+        Accepts `Sorter`, list of (field, direction) pairs or directions as
+        keyword arguments.
+        '''
+        if isinstance(sorter, Sorter):
+            sorter = sorter.sort_params
+        return self.stage('$sort', SON(list(sorter or []) + params.items()))
+
+    def skip(self, skip):
+        return self.stage('$skip', skip)
+
+    def limit(self, limit):
+        return self.stage('$limit', limit)
+
+    def unwind(self, path):
+        return self.stage('$unwind', path)
+
+    def lookup(self, from_collection, local_field, foreign_field, as_field):
+        '''
+        Joins documents of other collection (MongoDB 3.2+), which can be
+        given as collection class or name.
+        '''
+        if hasattr(from_collection, 'collection_name'):
+            from_collection = from_collection.collection_name()
+        return self.stage('$lookup', SON([
+            ('from', from_collection), ('localField', local_field),
+            ('foreignField', foreign_field), ('as', as_field)]))
+
+    def cursor(self, batch_size=100, allow_disk_use=False, db=None,
+               read_preference=None):
+        '''
+        Returns cursor of aggregation result. Without driver support of
+        command cursors, it's read with `ResultCursor`.
+        '''
+        db = self.manager.get_db(db, read_preference)
+        options = {}
+        if allow_disk_use:
+            options['allowDiskUse'] = True
+        if _COMMAND_CURSORS:
+            return db[self.manager.collection_name].aggregate(
+                self.pipeline, cursor={'batchSize': batch_size}, **options)
+        command = SON([('aggregate', self.manager.collection_name),
+                       ('pipeline', self.pipeline),
+                       ('cursor', {'batchSize': batch_size})])
+        command.update(options)
+        return ResultCursor(db, command, batch_size)
+
+    def stream(self, batch_size=100, model=None, trusted=None, lazy=None,
+               **kwargs):
+        '''
+        Returns `MotorStream` of results. If collection class `model` is
+        given, results are hydrated into its instances. Accepts `cursor`
+        options.
+        '''
+        cursor = self.cursor(batch_size=batch_size, **kwargs)
+        manager = model.objects if model is not None else self.manager
+        return manager.stream_class(manager, cursor, batch_size,
+                                    as_model=model is not None,
+                                    trusted=trusted, lazy=lazy)
+
+    @gen.engine
+    def all(self, callback, **kwargs):
+        '''
+        Returns list of all results, accepts `stream` options.
+        '''
+        stream = None
+        try:
+            stream = self.stream(**kwargs)
+            result = []
+            while True:
+                batch = yield motor.Op(stream.next_batch)
+                if not batch:
+                    break
+                result.extend(batch)
+        except Exception, e:
+            if stream is not None:
+                stream.close()
+            callback(None, e)
+            return
+        callback(result, None)
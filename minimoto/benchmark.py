@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmarks for fields validation, documents hydration and
+serialization. Usage:
+
+    python -m minimoto.benchmark --sizes 1000,10000 --save base.json
+    python -m minimoto.benchmark --sizes 1000,10000 --compare base.json
+
+Every benchmark reports operations per second and number of objects
+tracked by garbage collector, which are allocated by one operation.
+Managers calls are measured against in-process fake database, so they
+show overhead of manager layers only.
+'''
+
+import gc
+import re
+import sys
+import json
+import time
+import argparse
+
+import motor
+
+from datetime import datetime
+from bson import ObjectId
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import connector
+from collection import Collection
+from field import StringField, IntegerField, FloatField, DateTimeField, \
+    ListField, DictField, EmbeddedDocumentField, ObjectIdField
+from manager import BaseManager, FutureManager
+from loadtest import FakeClient
+from encoder import encoder_for, _default
+
+
+BENCHMARKS = []
+
+
+def benchmark(name, batch=False, ops=1):
+    '''
+    Registers benchmark. Decorated function gets batch size and returns
+    callable to measure. Batch benchmarks are run for every size and
+    report documents per second, others do `ops` operations per call.
+    '''
+    def decorator(func):
+        BENCHMARKS.append((name, func, batch, ops))
+        return func
+    return decorator
+
+
+def measure(func, ops=1, min_time=0.2, repeat=3):
+    '''
+    Returns best ops/sec of `repeat` runs, each run takes at least
+    `min_time` seconds.
+    '''
+    best = 0.0
+    for _ in range(repeat):
+        loops, elapsed = 0, 0.0
+        started = time.time()
+        while elapsed < min_time:
+            func()
+            loops += 1
+            elapsed = time.time() - started
+        best = max(best, ops * loops / elapsed)
+    return best
+
+
+def allocations(func, ops=1):
+    '''
+    Returns number of gc-tracked objects allocated (and still referenced
+    by result) per operation.
+    '''
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        result = func()
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+    del result
+    return float(after - before) / ops
+
+
+class Address(Collection):
+    city = StringField(max_length=100)
+    street = StringField()
+    zip_code = IntegerField(min_value=0)
+
+
+class Person(Collection):
+    _id = ObjectIdField()
+    name = StringField(regex=re.compile(r'^\w+'), min_length=1,
+                       max_length=100)
+    age = IntegerField(min_value=0, max_value=200)
+    rating = FloatField(default=0.0)
+    status = StringField(choices=(u'new', u'active', u'banned'))
+    created = DateTimeField()
+    address = EmbeddedDocumentField(Address)
+    addresses = ListField(Address, default=list)
+    tags = ListField(unicode, default=list)
+    meta = DictField(int, default=dict)
+
+
+def raw_address(i):
+    return {'city': u'City %d' % i, 'street': u'Street', 'zip_code': i}
+
+
+def raw_person(i):
+    return {
+        '_id': ObjectId(),
+        'name': u'user%d' % i,
+        'age': i % 100,
+        'rating': i / 10.0,
+        'status': u'active',
+        'created': datetime(2013, 1, 1),
+        'address': raw_address(i),
+        'addresses': [raw_address(i), raw_address(i + 1)],
+        'tags': [u'a', u'b'],
+        'meta': {'x': 1, 'y': 2},
+    }
+
+
+def _field_validate(field, value):
+    return lambda size: lambda: field.validate(value)
+
+
+for _name, _field, _value in [
+        ('StringField.validate', Person.name, u'username'),
+        ('IntegerField.validate', Person.age, 42),
+        ('DateTimeField.validate', Person.created, datetime(2013, 1, 1)),
+        ('ListField(Collection).validate', Person.addresses,
+         [raw_address(1), raw_address(2)]),
+        ('DictField.validate', Person.meta, {'x': 1, 'y': 2})]:
+    benchmark(_name)(_field_validate(_field, _value))
+
+
+@benchmark('Collection.create')
+def bench_create(size):
+    raw = raw_person(1)
+    return lambda: Person.create(raw)
+
+
+@benchmark('Collection._create')
+def bench_create_fallback(size):
+    raw = raw_person(1)
+    return lambda: Person._create(raw)
+
+
+@benchmark('Collection.create_trusted')
+def bench_create_trusted(size):
+    raw = raw_person(1)
+    return lambda: Person.create_trusted(raw)
+
+
+@benchmark('Collection.create_lazy')
+def bench_create_lazy(size):
+    raw = raw_person(1)
+    return lambda: Person.create_lazy(raw)
+
+
+@benchmark('Collection.as_dict')
+def bench_as_dict(size):
+    document = Person.create(raw_person(1))
+    return lambda: document.as_dict()
+
+
+@benchmark('Collection.as_dict(exclude_unset)')
+def bench_as_dict_exclude_unset(size):
+    document = Person.create(raw_person(1))
+    return lambda: document.as_dict(exclude_unset=True)
+
+
+@benchmark('Collection._as_dict')
+def bench_as_dict_fallback(size):
+    document = Person.create(raw_person(1))
+    return lambda: document._as_dict()
+
+
+@benchmark('Collection.validate(validate_embedded)')
+def bench_validate(size):
+    document = Person.create(raw_person(1))
+    return lambda: document.validate(validate_embedded=True)
+
+
+@benchmark('BaseManager.create', batch=True)
+def bench_manager_create(size):
+    manager = BaseManager(Person)
+    raw = [raw_person(i) for i in xrange(size)]
+    return lambda: manager.create(raw, trusted=False)
+
+
+@benchmark('BaseManager.create(row by row)', batch=True)
+def bench_manager_create_rows(size):
+    manager = BaseManager(Person)
+    manager.batch_hydration_size = sys.maxint
+    raw = [raw_person(i) for i in xrange(size)]
+    return lambda: manager.create(raw, trusted=False)
+
+
+@benchmark('BaseManager.create(trusted)', batch=True)
+def bench_manager_create_trusted(size):
+    manager = BaseManager(Person)
+    raw = [raw_person(i) for i in xrange(size)]
+    return lambda: manager.create(raw, trusted=True)
+
+
+@benchmark('BaseManager.create_dicts', batch=True)
+def bench_manager_create_dicts(size):
+    manager = BaseManager(Person)
+    raw = [raw_person(i) for i in xrange(size)]
+    return lambda: manager.create_dicts(raw)
+
+
+@benchmark('BaseManager.create_raw', batch=True)
+def bench_manager_create_raw(size):
+    manager = BaseManager(Person)
+    raw = [raw_person(i) for i in xrange(size)]
+    return lambda: manager.create_raw(raw)
+
+
+@benchmark('BaseManager.as_dicts', batch=True)
+def bench_manager_as_dicts(size):
+    manager = BaseManager(Person)
+    documents = manager.create([raw_person(i) for i in xrange(size)])
+    return lambda: manager.as_dicts(documents)
+
+
+@benchmark('json.dumps(as_dicts)', batch=True)
+def bench_json_dumps(size):
+    manager = BaseManager(Person)
+    documents = manager.create([raw_person(i) for i in xrange(size)])
+    return lambda: json.dumps(manager.as_dicts(documents), default=_default)
+
+
+@benchmark('DocumentEncoder.encode_list', batch=True)
+def bench_encode_list(size):
+    encoder = encoder_for(Person)
+    documents = BaseManager(Person).create(
+        [raw_person(i) for i in xrange(size)])
+    return lambda: encoder.encode_list(documents)
+
+
+BENCHMARK_ALIAS = 'benchmark'
+CALLS = 100
+
+
+class CallItem(Collection):
+    __collection__ = 'benchmark_items'
+    __db_alias__ = BENCHMARK_ALIAS
+
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class FutureCallItem(CallItem):
+    __manager__ = FutureManager
+
+
+def _fake_spec():
+    '''
+    Returns spec of document stored in fake database.
+    '''
+    if BENCHMARK_ALIAS not in connector._databases:
+        connector.connect('benchmark', alias=BENCHMARK_ALIAS,
+                          connection_class=FakeClient)
+    dbc = connector.current_db(BENCHMARK_ALIAS)[CallItem.__collection__]
+    if not dbc.documents:
+        dbc.insert({'name': u'item'})
+    return {'_id': next(iter(dbc.documents))}
+
+
+def _run_calls(func):
+    return lambda: IOLoop.instance().run_sync(func)
+
+
+@benchmark('FakeCollection.find_one', ops=CALLS)
+def bench_fake_find_one(size):
+    spec = _fake_spec()
+    dbc = connector.current_db(BENCHMARK_ALIAS)[CallItem.__collection__]
+
+    @gen.coroutine
+    def calls():
+        for _ in xrange(CALLS):
+            yield gen.Task(dbc.find_one, spec)
+    return _run_calls(calls)
+
+
+@benchmark('MotorManager.find_one', ops=CALLS)
+def bench_motor_find_one(size):
+    spec = _fake_spec()
+
+    @gen.coroutine
+    def calls():
+        for _ in xrange(CALLS):
+            yield motor.Op(CallItem.objects.find_one, spec)
+    return _run_calls(calls)
+
+
+@benchmark('FutureManager.find_one', ops=CALLS)
+def bench_future_find_one(size):
+    spec = _fake_spec()
+
+    @gen.coroutine
+    def calls():
+        for _ in xrange(CALLS):
+            yield FutureCallItem.objects.find_one(spec)
+    return _run_calls(calls)
+
+
+@benchmark('FutureManager.find_one(motor.Op)', ops=CALLS)
+def bench_future_find_one_adapter(size):
+    spec = _fake_spec()
+
+    @gen.coroutine
+    def calls():
+        for _ in xrange(CALLS):
+            yield motor.Op(FutureCallItem.objects.find_one, spec)
+    return _run_calls(calls)
+
+
+@benchmark('MotorManager.save', ops=CALLS)
+def bench_motor_save(size):
+    document = CallItem.create({'_id': _fake_spec()['_id'], 'name': u'item'})
+
+    @gen.coroutine
+    def calls():
+        for _ in xrange(CALLS):
+            yield motor.Op(CallItem.objects.save, document)
+    return _run_calls(calls)
+
+
+@benchmark('FutureManager.save', ops=CALLS)
+def bench_future_save(size):
+    document = FutureCallItem.create({'_id': _fake_spec()['_id'],
+                                      'name': u'item'})
+
+    @gen.coroutine
+    def calls():
+        for _ in xrange(CALLS):
+            yield FutureCallItem.objects.save(document)
+    return _run_calls(calls)
+
+
+@benchmark('FutureManager.save(motor.Op)', ops=CALLS)
+def bench_future_save_adapter(size):
+    document = FutureCallItem.create({'_id': _fake_spec()['_id'],
+                                      'name': u'item'})
+
+    @gen.coroutine
+    def calls():
+        for _ in xrange(CALLS):
+            yield motor.Op(FutureCallItem.objects.save, document)
+    return _run_calls(calls)
+
+
+def run(sizes, name_filter=None, min_time=0.2, out=sys.stdout):
+    results = {}
+    for name, factory, batch, ops in BENCHMARKS:
+        for size in (sizes if batch else [1]):
+            key = '%s[%d]' % (name, size) if batch else name
+            if name_filter and not re.search(name_filter, key):
+                continue
+            func = factory(size)
+            count = size if batch else ops
+            results[key] = {
+                'ops': measure(func, count, min_time=min_time),
+                'allocations': allocations(func, count),
+            }
+            out.write('%-45s %14.1f ops/s %10.1f objects/op\n' % (
+                key, results[key]['ops'], results[key]['allocations']))
+    return results
+
+
+def compare(results, baseline, threshold=0.1, out=sys.stdout):
+    '''
+    Prints ratio of results to baseline. Returns names of benchmarks, which
+    are slower than baseline more than `threshold`.
+    '''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        ratio = results[key]['ops'] / baseline[key]['ops']
+        mark = ''
+        if ratio < 1 - threshold:
+            mark = ' REGRESSION'
+            regressions.append(key)
+        out.write('%-45s %6.2fx%s\n' % (key, ratio, mark))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated batch sizes')
+    parser.add_argument('--filter', help='regex to select benchmarks')
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--save', help='file to store results')
+    parser.add_argument('--compare', help='file with baseline results')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown against baseline')
+    args = parser.parse_args(argv)
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    results = run(sizes, args.filter, args.min_time)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
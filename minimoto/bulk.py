@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import struct
+import logging
+import weakref
+import motor
+
+from bson import BSON, ObjectId
+from bson.son import SON
+from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+
+__all__ = ['BulkError', 'BulkWriter', 'WriteBehind', 'WriteQueue',
+           'flush_queues', ]
+
+
+class BulkError(Exception):
+    '''
+    Error of single operation in bulk write.
+    '''
+    def __init__(self, message, code=None, operation=None):
+        super(BulkError, self).__init__(message)
+        self.code = code
+        self.operation = operation
+
+
+def _as_document(document):
+    if hasattr(document, 'as_dict'):
+        return document.as_dict()
+    return document
+
+
+def _as_new_document(document, data=None):
+    '''
+    Returns document to insert with `_id`. Generated `_id` is assigned to
+    model too, so its later `save` doesn't insert it again.
+    '''
+    if data is None:
+        data = _as_document(document)
+    if data.get('_id') is None:
+        data['_id'] = ObjectId()
+        if data is not document:
+            document._id = data['_id']
+    return data
+
+
+def _save_operation(document):
+    data = _as_document(document)
+    if getattr(data, 'partial', False):
+        if data.get('_id') is None:
+            raise ValueError('Partial document w/o "_id" cannot be saved.')
+        return (BulkWriter.UPDATE, {'_id': data['_id']}, data.as_update(),
+                False, False)
+    if data.get('_id') is None:
+        return (BulkWriter.INSERT, None, _as_new_document(document, data),
+                False, False)
+    return (BulkWriter.UPDATE, {'_id': data['_id']}, data, True, False)
+
+
+def _operation_size(operation):
+    '''
+    Returns approximate size of operation in write command.
+    '''
+    _, spec, document, _, _ = operation
+    size = 32  # array index and options of command item
+    if spec is not None:
+        size += len(BSON.encode(spec))
+    if document is not None:
+        size += len(BSON.encode(document))
+    return size
+
+
+class BulkWriter(object):
+    '''
+    Collects write operations for manager collection and sends them to
+    database with write commands (MongoDB 2.6+), so every run of up to
+    `batch_size` operations of the same kind costs one round trip.
+    Usage:
+
+        writer = Model.objects.bulk(ordered=False)
+        for doc in docs:
+            writer.insert(doc)
+        writer.update({'a': 1}, {'$inc': {'b': 1}}, multi=True)
+        result = yield motor.Op(writer.execute)
+        # result['errors'] is list of (operation index, BulkError)
+
+    Commands are split by `batch_size` and by `max_batch_bytes`, so they
+    fit maximal BSON document size.
+    '''
+    INSERT, UPDATE, REMOVE = 'insert', 'update', 'remove'
+    # 16MB limit of BSON document without space for command envelope
+    max_batch_bytes = 16 * 1024 * 1024 - 16 * 1024
+
+    def __init__(self, manager, ordered=True, batch_size=1000):
+        self.manager = manager
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.operations = []
+
+    def insert(self, document):
+        self.operations.append((self.INSERT, None,
+                                _as_new_document(document), False, False))
+        return self
+
+    def save(self, document):
+        '''
+        Saves dict or model like `MotorManager.save`, partial document is
+        saved with `$set` of loaded fields only.
+        '''
+        self.operations.append(_save_operation(document))
+        return self
+
+    def update(self, spec, document, upsert=False, multi=False):
+        self.operations.append((self.UPDATE, spec, _as_document(document),
+                                upsert, multi))
+        return self
+
+    def remove(self, spec, multi=True):
+        self.operations.append((self.REMOVE, spec, None, False, multi))
+        return self
+
+    def __len__(self):
+        return len(self.operations)
+
+    def _command(self, kind, operations, write_concern):
+        if kind == self.INSERT:
+            items = []
+            for _, _, document, _, _ in operations:
+                if document.get('_id') is None:
+                    document['_id'] = ObjectId()
+                items.append(document)
+            name, field = 'insert', 'documents'
+        elif kind == self.UPDATE:
+            items = [{'q': spec, 'u': document, 'upsert': upsert,
+                      'multi': multi}
+                     for _, spec, document, upsert, multi in operations]
+            name, field = 'update', 'updates'
+        else:
+            items = [{'q': spec, 'limit': 0 if multi else 1}
+                     for _, spec, _, _, multi in operations]
+            name, field = 'delete', 'deletes'
+        command = SON([(name, self.manager.collection_name),
+                       (field, items), ('ordered', self.ordered)])
+        if write_concern:
+            command['writeConcern'] = write_concern
+        return command
+
+    def _groups(self, operations):
+        '''
+        Splits operations to groups of same kind, which can be sent with
+        one write command. Operation bigger than `max_batch_bytes` is sent
+        alone.
+        '''
+        sizes = [_operation_size(x) for x in operations]
+        offset = 0
+        while offset < len(operations):
+            kind = operations[offset][0]
+            size = sizes[offset]
+            end = offset + 1
+            while end < len(operations) and end - offset < self.batch_size \
+                    and operations[end][0] == kind and \
+                    size + sizes[end] <= self.max_batch_bytes:
+                size += sizes[end]
+                end += 1
+            yield kind, offset, operations[offset:end]
+            offset = end
+
+    @gen.engine
+    def execute(self, callback, db=None, **write_concern):
+        '''
+        Sends collected operations using write commands. Result is dict with
+        counters and `errors` list. If writer is ordered, operations after
+        failed one are reported as not executed.
+        '''
+        operations, self.operations = self.operations, []
+        result = {
+            'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+            'nModified': 0, 'nRemoved': 0, 'errors': [],
+        }
+        try:
+            db = self.manager.get_db(db)
+            for kind, offset, group in self._groups(operations):
+                command = self._command(kind, group, write_concern)
+                response = yield motor.Op(db.command, command)
+                n = response.get('n', 0)
+                if kind == self.INSERT:
+                    result['nInserted'] += n
+                elif kind == self.UPDATE:
+                    upserted = len(response.get('upserted', []))
+                    result['nUpserted'] += upserted
+                    result['nMatched'] += n - upserted
+                    result['nModified'] += response.get('nModified', 0)
+                else:
+                    result['nRemoved'] += n
+                for error in response.get('writeErrors', []):
+                    index = offset + error['index']
+                    result['errors'].append((index, BulkError(
+                        error.get('errmsg'), error.get('code'),
+                        operations[index])))
+                if self.ordered and result['errors']:
+                    failed = result['errors'][-1][0]
+                    for index in range(failed + 1, len(operations)):
+                        result['errors'].append((index, BulkError(
+                            'Operation was not executed.',
+                            operation=operations[index])))
+                    break
+        except Exception, e:
+            callback(None, e)
+            return
+        finally:
+            self.manager.invalidate()
+        callback(result, None)
+
+
+class WriteBehind(object):
+    '''
+    Buffers write operations and flushes them as bulk write when buffer has
+    `max_size` operations or `max_delay` seconds have passed since first
+    buffered operation. Result or error of every operation is passed to its
+    own callback.
+    '''
+
+    def __init__(self, manager, max_size=1000, max_delay=1.0, ordered=False,
+                 io_loop=None, db=None, **write_concern):
+        self.manager = manager
+        self.db = db
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.ordered = ordered
+        self.io_loop = io_loop or IOLoop.instance()
+        self.write_concern = write_concern
+        self._writer = self._new_writer()
+        self._callbacks = []
+        self._timeout = None
+
+    def _new_writer(self):
+        return BulkWriter(self.manager, ordered=self.ordered,
+                          batch_size=self.max_size)
+
+    def insert(self, document, callback=None):
+        self._writer.insert(document)
+        self._added(callback)
+
+    def save(self, document, callback=None):
+        self._writer.save(document)
+        self._added(callback)
+
+    def update(self, spec, document, upsert=False, multi=False,
+               callback=None):
+        self._writer.update(spec, document, upsert=upsert, multi=multi)
+        self._added(callback)
+
+    def remove(self, spec, multi=True, callback=None):
+        self._writer.remove(spec, multi=multi)
+        self._added(callback)
+
+    def __len__(self):
+        return len(self._callbacks)
+
+    def _added(self, callback):
+        # callbacks of many writers are called from one flush
+        self._callbacks.append(stack_context.wrap(callback))
+        # buffer doesn't belong to context of any particular writer
+        with stack_context.NullContext():
+            if len(self._callbacks) >= self.max_size:
+                self.flush()
+            elif self._timeout is None and self.max_delay:
+                self._timeout = self.io_loop.add_timeout(
+                    time.time() + self.max_delay, self.flush)
+
+    @gen.engine
+    def flush(self, callback=None):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        writer, self._writer = self._writer, self._new_writer()
+        callbacks, self._callbacks = self._callbacks, []
+        if not callbacks:
+            if callback is not None:
+                callback(None, None)
+            return
+        try:
+            result = yield motor.Op(writer.execute, db=self.db,
+                                    **self.write_concern)
+        except Exception, e:
+            for op_callback in callbacks:
+                _notify(op_callback, None, e)
+            if callback is not None:
+                callback(None, e)
+            return
+        errors = dict(result['errors'])
+        for index, op_callback in enumerate(callbacks):
+            error = errors.get(index)
+            if error is not None:
+                _notify(op_callback, None, error)
+            else:
+                _notify(op_callback, True, None)
+        if callback is not None:
+            callback(result, None)
+
+
+def _notify(callback, result, error):
+    if callback is None:
+        return
+    try:
+        callback(result, error)
+    except Exception:
+        logging.error('Exception in write callback', exc_info=True)
+
+
+class WriteQueue(object):
+    '''
+    Bounded queue of unacknowledged writes. Writes are enqueued and return
+    immediately, background coroutine sends them in batches with relaxed
+    write concern (`w=0` by default). If queue has `max_size` writes, new
+    write is handled by `overflow` policy:
+
+      - `drop`: write is dropped and counted in `stats['dropped']`;
+      - `block`: write waits for free space, producer should wait for its
+        callback to slow down;
+      - `spill`: write is appended to `spill_path` file and sent after
+        queue is drained.
+
+    Queues should be flushed on shutdown, e.g.:
+
+        yield motor.Op(flush_queues)
+        IOLoop.instance().stop()
+    '''
+    DROP, BLOCK, SPILL = 'drop', 'block', 'spill'
+    ACTIONS = ('insert', 'save', 'update', 'remove')
+
+    def __init__(self, manager, max_size=10000, batch_size=1000,
+                 overflow=DROP, spill_path=None, io_loop=None, db=None,
+                 **write_concern):
+        assert overflow in (self.DROP, self.BLOCK, self.SPILL)
+        assert overflow != self.SPILL or spill_path, '`spill_path` required'
+        self.manager = manager
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.io_loop = io_loop or IOLoop.instance()
+        self.db = db
+        self.write_concern = write_concern or {'w': 0}
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'spilled': 0,
+                      'failed': 0, 'batches': 0}
+        self._queue = []
+        self._waiting = []  # (operation, callback) blocked by full queue
+        self._spilled = 0  # operations in spill file, which weren't read
+        self._spill_offset = 0
+        self._draining = False
+        self._flushed = []
+        if overflow == self.SPILL:
+            self._recover()
+        _queues.add(self)
+
+    def __len__(self):
+        return len(self._queue) + len(self._waiting) + self._spilled
+
+    def put(self, action, args=(), kwargs=None, callback=None):
+        '''
+        Enqueues manager operation, e.g. `put('update', (spec, document),
+        {'multi': True})`. Returns what acknowledged operation would return
+        (`_id` for inserts and saves). The same result is passed to
+        `callback` when all writes are enqueued or dropped.
+        '''
+        operations, result = _parse_write(action, args, kwargs or {})
+        if callback is None:
+            for operation in operations:
+                self._put(operation)
+            return result
+        # blocked writes are resumed from drain
+        callback = stack_context.wrap(callback)
+        pending = [len(operations)]
+
+        def enqueued(_, error):
+            pending[0] -= 1
+            if not pending[0]:
+                callback(result, None)
+        for operation in operations:
+            self._put(operation, enqueued)
+        return result
+
+    def _put(self, operation, callback=None):
+        if len(self._queue) < self.max_size and not self._waiting and \
+                not self._spilled:
+            self._enqueue(operation, callback)
+        elif self.overflow == self.BLOCK:
+            self._waiting.append((operation, callback))
+        elif self.overflow == self.SPILL:
+            self._spill(operation)
+            _notify(callback, True, None)
+        else:
+            self.stats['dropped'] += 1
+            _notify(callback, False, None)
+        self._schedule()
+
+    def _enqueue(self, operation, callback=None):
+        self._queue.append(operation)
+        self.stats['queued'] += 1
+        _notify(callback, True, None)
+
+    def _recover(self):
+        '''
+        Counts writes spilled by previous process, they are sent first.
+        Record, which was not written completely, is cut off, so next
+        records are appended after the last complete one.
+        '''
+        if not os.path.exists(self.spill_path):
+            return
+        size = os.path.getsize(self.spill_path)
+        end = 0
+        with open(self.spill_path, 'r+b') as f:
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                length = struct.unpack('<i', header)[0]
+                if length < 5 or end + length > size:  # BSON is 5+ bytes
+                    break
+                end += length
+                f.seek(end)
+                self._spilled += 1
+            if end < size:
+                f.truncate(end)
+        if not self._spilled:
+            os.remove(self.spill_path)
+        else:
+            self._refill()
+            self._schedule()
+
+    def _spill(self, operation):
+        kind, spec, document, upsert, multi = operation
+        record = BSON.encode({'k': kind, 's': spec, 'd': document,
+                              'u': upsert, 'm': multi})
+        with open(self.spill_path, 'ab') as f:
+            f.write(record)
+        self._spilled += 1
+        self.stats['spilled'] += 1
+
+    def _unspill(self, count):
+        '''
+        Reads up to `count` spilled operations back to queue.
+        '''
+        with open(self.spill_path, 'rb') as f:
+            f.seek(self._spill_offset)
+            for _ in xrange(min(count, self._spilled)):
+                size = struct.unpack('<i', f.read(4))[0]
+                f.seek(-4, os.SEEK_CUR)
+                record = BSON(f.read(size)).decode()
+                self._queue.append((record['k'], record['s'], record['d'],
+                                    record['u'], record['m']))
+                self._spilled -= 1
+            self._spill_offset = f.tell()
+        if not self._spilled:
+            os.remove(self.spill_path)
+            self._spill_offset = 0
+
+    def _schedule(self):
+        if not self._draining and self._queue:
+            self._draining = True
+            # queue doesn't belong to context of any particular writer
+            with stack_context.NullContext():
+                self.io_loop.add_callback(self._drain)
+
+    @gen.engine
+    def _drain(self):
+        error = None
+        try:
+            while self._queue:
+                batch = self._queue[:self.batch_size]
+                del self._queue[:self.batch_size]
+                writer = BulkWriter(self.manager, ordered=False,
+                                    batch_size=self.batch_size)
+                writer.operations = batch
+                try:
+                    result = yield motor.Op(writer.execute, db=self.db,
+                                            **self.write_concern)
+                    # errors are reported only with acknowledged write
+                    # concern
+                    failed = len(result['errors'])
+                    self.stats['sent'] += len(batch) - failed
+                    self.stats['failed'] += failed
+                except Exception:
+                    self.stats['failed'] += len(batch)
+                    logging.error('Unacknowledged writes failed',
+                                  exc_info=True)
+                self.stats['batches'] += 1
+                self._refill()
+        except Exception, e:  # e.g. spill file cannot be read
+            error = e
+            logging.error('Write queue cannot be drained', exc_info=True)
+        finally:
+            # next write or flush starts draining again
+            self._draining = False
+        flushed, self._flushed = self._flushed, []
+        for callback in flushed:
+            _notify(callback, self.stats, error)
+
+    def _refill(self):
+        while self._waiting and len(self._queue) < self.max_size:
+            self._enqueue(*self._waiting.pop(0))
+        free = self.max_size - len(self._queue)
+        if self._spilled and free > 0:
+            self._unspill(free)
+
+    def flush(self, callback=None):
+        '''
+        Sends all queued and spilled writes. Result is queue stats.
+        '''
+        if callback is not None:
+            if not self._draining and not self._queue:
+                callback(self.stats, None)
+                return
+            self._flushed.append(stack_context.wrap(callback))
+        self._schedule()
+
+
+def _parse_write(action, args, kwargs):
+    '''
+    Converts arguments of collection write method to `BulkWriter`
+    operations.
+    '''
+    if action in ('insert', 'save'):
+        documents = args[0] if args else kwargs.get(
+            'doc_or_docs', kwargs.get('to_save'))
+        many = isinstance(documents, (list, tuple))
+        if not many:
+            documents = [documents]
+        operations, ids = [], []
+        for document in documents:
+            if action == 'insert':
+                operation = (BulkWriter.INSERT, None,
+                             _as_new_document(document), False, False)
+                ids.append(operation[2]['_id'])
+            else:
+                operation = _save_operation(document)
+                # inserted document has no spec
+                ids.append((operation[1] or operation[2])['_id'])
+            operations.append(operation)
+        return operations, ids if many else ids[0]
+    elif action == 'update':
+        spec = args[0] if args else kwargs['spec']
+        document = args[1] if len(args) > 1 else kwargs['document']
+        upsert = args[2] if len(args) > 2 else kwargs.get('upsert', False)
+        return [(BulkWriter.UPDATE, spec, _as_document(document), upsert,
+                 kwargs.get('multi', False))], None
+    elif action == 'remove':
+        spec = args[0] if args else kwargs.get('spec_or_id')
+        if spec is None:
+            spec = {}
+        elif not isinstance(spec, dict):
+            spec = {'_id': spec}
+        return [(BulkWriter.REMOVE, spec, None, False, True)], None
+    raise ValueError('Operation "%s" cannot be queued.' % (action,))
+
+
+_queues = weakref.WeakSet()
+
+
+@gen.engine
+def flush_queues(callback=None):
+    '''
+    Flushes all write queues, e.g. before shutdown.
+    '''
+    queues = list(_queues)
+    if queues:
+        yield [gen.Task(queue.flush) for queue in queues]
+    if callback is not None:
+        callback(len(queues), None)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import collections
+
+
+__all__ = ['TTLCache', 'LRUCache', ]
+
+
+class TTLCache(object):
+    '''
+    Simple in-process cache, where every entry expires after `ttl` seconds.
+    '''
+
+    def __init__(self, ttl=60, timer=time.time):
+        self.ttl = ttl
+        self.timer = timer
+        self._data = {}
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires is not None and expires <= self.timer():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = self.timer() + ttl if ttl else None
+        self._data[key] = (value, expires)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LRUCache(TTLCache):
+    '''
+    TTL cache, which keeps at most `max_size` recently used entries and
+    collects hit/miss/eviction statistics.
+    '''
+
+    def __init__(self, max_size=1000, ttl=60, timer=time.time):
+        super(LRUCache, self).__init__(ttl=ttl, timer=timer)
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            value, expires = entry
+            if expires is None or expires > self.timer():
+                self._data[key] = entry  # most recently used goes last
+                self.hits += 1
+                return value
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        self._data.pop(key, None)
+        super(LRUCache, self).set(key, value, ttl)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and \
+            (entry[1] is None or entry[1] > self.timer())
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+        }
+
+
+_MISSING = object()
@@ -5,8 +5,10 @@ from __future__ import absolute_import
 
 import inspect
 import UserDict
-from models.field import Field, ListField
-from models.manager import MotorManager
+import itertools
+from field import Field, ListField, DictField, \
+    EmbeddedDocumentField, NormalizedField
+from manager import MotorManager
 
 
 isfield = lambda x: isinstance(x, Field)
@@ -15,7 +17,8 @@ _is_collections_field = lambda x: isinstance(x, ListField) and \
 
 
 def inspect_fields(collection_class):
-    if not hasattr(collection_class, '__fields__'):
+    # check own class dict, because `__fields__` of base class is inherited
+    if '__fields__' not in collection_class.__dict__:
         collection_class.__fields__ = fields = {}
         for name in dir(collection_class):  # with inherited props
             if name.startswith('__'):
@@ -34,6 +37,247 @@ def reset_lazy_classes():
 __lazy_classes__ = {}
 
 
+class PartialDict(dict):
+    '''
+    Result of `as_dict` for partial document. Manager saves it with `$set`,
+    so fields which were not loaded are kept.
+    '''
+    partial = True
+
+    def as_update(self, prefix=''):
+        to_set = {}
+        for name, value in self.iteritems():
+            path = prefix + name
+            if isinstance(value, PartialDict):
+                to_set.update(value.as_update(path + '.')['$set'])
+            elif isinstance(value, list) and \
+                    any([isinstance(v, PartialDict) for v in value]):
+                raise ValueError('List "%s" of partial documents cannot be '
+                                 'saved.' % (path,))
+            elif path != '_id':
+                to_set[path] = value
+        return {'$set': to_set}
+
+
+def _has_custom_init(collection_class):
+    for klass in collection_class.__mro__:
+        if '__metaclass__' in klass.__dict__:  # root collection class
+            return False
+        if '__init__' in klass.__dict__:
+            return True
+    return False
+
+
+def compile_loader(collection_class):
+    '''
+    Builds function that creates `collection_class` instance from raw data.
+    It does the same as `Collection.__init__`, but skips `update()` and
+    descriptors machinery for every field.
+    '''
+    setters = {}
+    for name, field in inspect_fields(collection_class).iteritems():
+        setters[name] = (field.name, field.validate)
+    new = collection_class.__new__
+
+    def load(raw_data, strict=True):
+        obj = new(collection_class)
+        obj._data = data = {}
+        for name, value in raw_data.iteritems():
+            setter = setters.get(name)
+            if setter is None:
+                try:
+                    name = str(name)
+                except:
+                    if strict:
+                        raise
+                    continue
+                raise KeyError('Collection "%s" has no field "%s".' %
+                               (collection_class.collection_name(), name))
+            field_name, validate = setter
+            data[field_name] = validate(value, obj)
+        return obj
+    return load
+
+
+def compile_batch_loader(collection_class):
+    '''
+    Builds function that creates `collection_class` instances from list of
+    raw data, like `compile_loader` does. But values are validated column
+    by column (see `Field.validate_column`), so type, choices and range
+    checks are done once per field for whole batch. Function returns list
+    of documents and dict of errors by row index, invalid rows are `None`.
+    '''
+    fields = inspect_fields(collection_class)
+    # columns are validated in order of fields, so first error of row is
+    # deterministic
+    order = dict([(name, i) for i, name in enumerate(sorted(fields))])
+    new = collection_class.__new__
+
+    def load(rows, strict=True):
+        documents, errors, columns = [], {}, {}
+        for row, raw_data in enumerate(rows):
+            obj = new(collection_class)
+            obj._data = {}
+            documents.append(obj)
+            for name, value in raw_data.iteritems():
+                column = columns.get(name)
+                if column is None:
+                    if name not in fields:
+                        try:
+                            name = str(name)
+                        except Exception, e:
+                            if strict:
+                                errors.setdefault(row, e)
+                            continue
+                        errors.setdefault(row, KeyError(
+                            'Collection "%s" has no field "%s".' %
+                            (collection_class.collection_name(), name)))
+                        continue
+                    column = columns[name] = ([], [])
+                column[0].append(row)
+                column[1].append(value)
+
+        for name in sorted(columns, key=order.get):
+            field = fields[name]
+            positions, values = columns[name]
+            objs = [documents[row] for row in positions]
+            values, column_errors = field.validate_column(values, objs)
+            for i in sorted(column_errors):
+                errors.setdefault(positions[i], column_errors[i])
+            field_name = field.name
+            for obj, value in itertools.izip(objs, values):
+                obj._data[field_name] = value
+
+        for row in errors:
+            documents[row] = None
+        return documents, errors
+    return load
+
+
+def _trusted_converter(field):
+    '''
+    Returns function that converts raw value of `field` to embedded
+    documents without validation, or `None` if value can be used as is.
+    '''
+    if isinstance(field, EmbeddedDocumentField):
+        document_type = field.document_type
+    elif isinstance(field, (ListField, DictField)) and \
+            isinstance(field.item_type, CollectionMetaClass):
+        document_type = field.item_type
+    else:
+        return None
+
+    def convert_one(value, parent):
+        if isinstance(value, dict):
+            value = document_type.create_trusted(value)
+            value.__parent__ = parent
+        return value
+
+    if isinstance(field, EmbeddedDocumentField):
+        return convert_one
+    elif isinstance(field, ListField):
+        return lambda value, parent: value and \
+            [convert_one(v, parent) for v in value]
+    return lambda value, parent: value and \
+        dict([(k, convert_one(v, parent)) for k, v in value.iteritems()])
+
+
+def compile_trusted_loader(collection_class):
+    '''
+    Same as `compile_loader`, but returned function fills instance data
+    without validation. It's intended for documents read from database,
+    which were validated on write.
+    '''
+    converters = {}
+    for name, field in inspect_fields(collection_class).iteritems():
+        converters[name] = (field.name, _trusted_converter(field))
+    new = collection_class.__new__
+
+    def load(raw_data, strict=True):
+        obj = new(collection_class)
+        obj._data = data = {}
+        for name, value in raw_data.iteritems():
+            converter = converters.get(name)
+            if converter is None:
+                try:
+                    name = str(name)
+                except:
+                    if strict:
+                        raise
+                    continue
+                raise KeyError('Collection "%s" has no field "%s".' %
+                               (collection_class.collection_name(), name))
+            field_name, convert = converter
+            if convert is not None and value is not None:
+                value = convert(value, obj)
+            data[field_name] = value
+        return obj
+    return load
+
+
+_PLAIN, _ANY, _DOCUMENT, _DOCUMENTS = range(4)
+
+
+def set_field_name(collection_class, field):
+    '''
+    Returns name of field, which value means that `field` is set, i.e.
+    source field for `NormalizedField`.
+    '''
+    if isinstance(field, NormalizedField):
+        return inspect_fields(collection_class)[field.source].name
+    return field.name
+
+
+def compile_dumper(collection_class):
+    '''
+    Builds function that converts `collection_class` instance to dict, the
+    same way as `Collection.as_dict` does.
+    '''
+    getters = []
+    for name, field in inspect_fields(collection_class).iteritems():
+        if isinstance(field, EmbeddedDocumentField):
+            kind = _DOCUMENT
+        elif isinstance(field, ListField) and \
+                isinstance(field.item_type, CollectionMetaClass):
+            kind = _DOCUMENTS
+        elif field.field_type is not None and \
+                not isinstance(field.field_type, CollectionMetaClass):
+            kind = _PLAIN  # value can't be collection instance
+        else:
+            kind = _ANY
+        getters.append((name, field.name,
+                        set_field_name(collection_class, field),
+                        field.required, field.__get__, kind))
+
+    def dump(obj, exclude_unset=False):
+        data = {}
+        obj_data = obj._data
+        loaded = obj._loaded
+        for name, field_name, set_name, required, get, kind in getters:
+            if loaded is not None and field_name not in loaded and \
+                    field_name not in obj_data and set_name not in loaded \
+                    and set_name not in obj_data:
+                continue  # not loaded due to projection
+            value = get(obj, collection_class)
+            if exclude_unset and not required and set_name not in obj_data:
+                continue
+            if kind == _PLAIN:
+                pass
+            elif kind == _DOCUMENTS:
+                if value:
+                    value = [v.as_dict(exclude_unset) for v in value]
+            elif isinstance(value, Collection):
+                value = value.as_dict(exclude_unset)
+            data[name] = value
+        # Because we don't want pass empty `_id` to client code
+        if not data.get('_id'):
+            data.pop('_id', None)
+        if loaded is not None:
+            data = PartialDict(data)
+        return data
+    return dump
+
+
 class CollectionMetaClass(type):
 
     def __new__(cls, name, bases, attrs):
@@ -73,6 +317,35 @@ class CollectionMetaClass(type):
         elif objects.collection is None:
             objects.collection = new_class
 
+        # fields stored under other name than attribute name
+        new_class.__renamed_fields__ = dict(
+            [(attr_name, field.name) for attr_name, field
+             in inspect_fields(new_class).iteritems()
+             if attr_name != field.name])
+        # source field name -> names of its `NormalizedField` shadows
+        shadows = {}
+        for attr_name, field in inspect_fields(new_class).iteritems():
+            if isinstance(field, NormalizedField):
+                shadows.setdefault(field.source, []).append(attr_name)
+        new_class.__shadow_fields__ = shadows
+
+        # Compiled loader doesn't call `__init__`, so it can't be used if
+        # class has own initialisation logic.
+        if new_class.__compiled__ and not _has_custom_init(new_class):
+            new_class.__compiled_loader__ = staticmethod(
+                compile_loader(new_class))
+            new_class.__compiled_dumper__ = staticmethod(
+                compile_dumper(new_class))
+            new_class.__trusted_loader__ = staticmethod(
+                compile_trusted_loader(new_class))
+            new_class.__batch_loader__ = staticmethod(
+                compile_batch_loader(new_class))
+        else:
+            new_class.__compiled_loader__ = None
+            new_class.__compiled_dumper__ = None
+            new_class.__trusted_loader__ = None
+            new_class.__batch_loader__ = None
+
         __lazy_classes__[name] = new_class
         return new_class
 
@@ -136,6 +409,26 @@ class Collection(object, DocumentMixin):
     __metaclass__ = CollectionMetaClass
     __manager__ = MotorManager
     __collection__ = None
+    # use compiled loader and dumper (see `compile_loader`)
+    __compiled__ = True
+    # documents are read from database lazily (see `create_lazy`)
+    __lazy__ = False
+    # options of manager read-through cache (see `MotorManager.cache`)
+    __cache__ = None
+    # alias of registered database and read preference used by manager
+    __db_alias__ = None
+    __read_preference__ = None
+    # name of integer field, which is incremented by every versioned write
+    # (see `MotorManager.save_versioned`)
+    __version_field__ = None
+
+    # raw data of lazy document, which wasn't read yet
+    _raw = None
+    _trusted = False
+    # names of fields changed since document was loaded
+    _dirty = None
+    # names of fields loaded with projection, `None` if all fields loaded
+    _loaded = None
 
     def __new__(cls, class_name=None, *args, **kwargs):
         if class_name:
@@ -162,11 +455,19 @@ class Collection(object, DocumentMixin):
         self._data = {}
         self.update(*args, **kwargs)
 
-    def validate(self, validate_embedded=False):
+    def validate(self, validate_embedded=False, fields=None):
+        '''
+        Checks required fields. If `fields` are given only these fields are
+        checked (dotted paths are allowed for embedded documents).
+        '''
         #TODO: reduce boilerplate code to traverse document tree
+        if fields is not None:
+            return self._validate_paths(fields)
         fields = inspect_fields(self.__class__)
         missing = []
         for name, field in fields.iteritems():
+            if not self.is_loaded(name):
+                continue
             value = getattr(self, name)
             if field.required and field.is_empty(value):
                 missing.append(field.name)
@@ -180,13 +481,193 @@ class Collection(object, DocumentMixin):
             raise ValueError(
                 'Required fields %s must have non-empty values.' % (missing,))
 
+    def _validate_paths(self, paths):
+        fields = inspect_fields(self.__class__)
+        missing = []
+        embedded = {}
+        for path in paths:
+            name, _, rest = path.partition('.')
+            field = fields[name]
+            value = getattr(self, name)
+            if rest:
+                embedded.setdefault(name, []).append(rest)
+            elif field.required and field.is_empty(value):
+                missing.append(field.name)
+            elif isinstance(value, Collection):
+                value.validate(validate_embedded=True)
+            elif value and _is_collections_field(field):
+                [v.validate(validate_embedded=True) for v in value]
+        if missing:
+            raise ValueError(
+                'Required fields %s must have non-empty values.' % (missing,))
+        for name, paths in embedded.iteritems():
+            getattr(self, name).validate(fields=paths)
+
+    def is_loaded(self, name):
+        '''
+        Returns `False` if field was not loaded due to projection.
+        '''
+        if self._loaded is None:
+            return True
+        field = inspect_fields(self.__class__)[name]
+        if field.name in self._loaded or field.name in self._data:
+            return True
+        # normalized shadow is computed from its source
+        return isinstance(field, NormalizedField) and \
+            self.is_loaded(field.source)
+
+    @property
+    def partial(self):
+        return self._loaded is not None
+
+    def set_projection(self, projection):
+        '''
+        Marks document as partial. `projection` is `fields` argument used
+        to load document (list of names or dict).
+        '''
+        if projection is None:
+            return
+        if not isinstance(projection, dict):
+            projection = dict([(x, 1) for x in projection])
+        fields = inspect_fields(self.__class__)
+        whole, nested = {}, {}
+        for path, value in projection.iteritems():
+            name, _, rest = path.partition('.')
+            if rest:
+                nested.setdefault(name, {})[rest] = value
+            else:
+                whole[name] = value
+        # mongo doesn't allow to mix inclusion and exclusion except `_id`
+        if any([v for k, v in projection.iteritems() if k != '_id']):
+            names = set([k for k, v in whole.iteritems() if v and k != '_id'])
+            names.update(nested)
+            if whole.get('_id', 1):
+                names.add('_id')
+        else:
+            names = set(fields) - set([k for k, v in whole.iteritems() if not v])
+        loaded = set()
+        for name in names:
+            field = fields.get(name)
+            if field is None:
+                continue
+            loaded.add(field.name)
+            if name in nested:
+                value = getattr(self, name)
+                if isinstance(value, Collection):
+                    value.set_projection(nested[name])
+                elif value and _is_collections_field(field):
+                    [v.set_projection(nested[name]) for v in value]
+        self._loaded = loaded
+
+    def complete(self, raw_data, trusted=True):
+        '''
+        Fills fields, which were not loaded, from raw data and marks
+        document as fully loaded.
+        '''
+        fields = inspect_fields(self.__class__)
+        for name, field in fields.iteritems():
+            if field.name in self._data:
+                value = self._data[field.name]
+                if isinstance(value, Collection) and value.partial and \
+                        isinstance(raw_data.get(name), dict):
+                    value.complete(raw_data[name], trusted=trusted)
+                continue
+            if self._raw and field.name in self._raw:
+                continue
+            if name in raw_data:
+                self._data[field.name] = field.load(
+                    raw_data[name], self, trusted)
+        self._loaded = None
+
+    def missing_fields(self):
+        '''
+        Returns names of fields, which were not loaded or loaded partially.
+        '''
+        missing = []
+        for name, field in inspect_fields(self.__class__).iteritems():
+            value = self._data.get(field.name)
+            if not self.is_loaded(name) or \
+                    (isinstance(value, Collection) and value.partial):
+                missing.append(name)
+        return missing
+
+    def dirty_fields(self):
+        '''
+        Returns paths of fields changed since document was loaded or saved.
+        Note that in-place changes of mutable values are not tracked.
+        '''
+        dirty = self._dirty or ()
+        paths = []
+        for name, field in inspect_fields(self.__class__).iteritems():
+            if field.name in dirty:
+                paths.append(name)
+                continue
+            value = self._data.get(field.name)
+            if isinstance(value, Collection):
+                paths.extend(['%s.%s' % (name, path)
+                              for path in value.dirty_fields()])
+            elif value and _is_collections_field(field):
+                # items can be moved, so whole list is rewritten
+                if any([v.dirty_fields() for v in value
+                        if isinstance(v, Collection)]):
+                    paths.append(name)
+        # normalized shadows are saved with their source fields
+        for source, shadows in self.__shadow_fields__.iteritems():
+            if source in paths:
+                paths.extend([x for x in shadows if x not in paths])
+        return paths
+
+    def mark_clean(self):
+        self._dirty = None
+        for value in self._data.itervalues():
+            if isinstance(value, Collection):
+                value.mark_clean()
+            elif isinstance(value, list):
+                [v.mark_clean() for v in value if isinstance(v, Collection)]
+
+    def changes(self, paths=None):
+        '''
+        Returns update document with `$set` and `$unset` operators for
+        changed fields.
+        '''
+        if paths is None:
+            paths = self.dirty_fields()
+        to_set, to_unset = {}, {}
+        for path in paths:
+            value = self
+            for name in path.split('.'):
+                value = getattr(value, name)
+            if value is None:
+                to_unset[path] = 1
+                continue
+            if isinstance(value, Collection):
+                value = value.as_dict()
+            elif isinstance(value, list):
+                value = [v.as_dict() if isinstance(v, Collection) else v
+                         for v in value]
+            to_set[path] = value
+        update = {}
+        if to_set:
+            update['$set'] = to_set
+        if to_unset:
+            update['$unset'] = to_unset
+        return update
+
     def as_dict(self, exclude_unset=False):
+        dump = self.__compiled_dumper__
+        if dump is not None:
+            return dump(self, exclude_unset)
+        return self._as_dict(exclude_unset)
+
+    def _as_dict(self, exclude_unset=False):
         fields = inspect_fields(self.__class__)
         data = {}
         for name, field in fields.iteritems():
+            if not self.is_loaded(name):
+                continue
             value = getattr(self, name)
             if exclude_unset and not field.required and \
-                    field.name not in self._data:
+                    set_field_name(self.__class__, field) not in self._data:
                 continue
             if isinstance(value, Collection):
                 value = value.as_dict(exclude_unset)
@@ -196,10 +677,71 @@ class Collection(object, DocumentMixin):
         # Because we don't want pass empty `_id` to client code
         if not data.get('_id'):
             data.pop('_id', None)
+        if self.partial:
+            data = PartialDict(data)
         return data
 
     @classmethod
     def create(cls, raw_data, strict=True):
+        load = cls.__compiled_loader__
+        if load is not None:
+            return load(raw_data, strict)
+        return cls._create(raw_data, strict)
+
+    @classmethod
+    def create_batch(cls, rows, strict=True, columnar=True):
+        '''
+        Creates instances from list of raw data. Returns list of documents
+        and dict of errors by row index, invalid rows are `None`. Without
+        `columnar` rows are validated one by one, which is cheaper for short
+        batches.
+        '''
+        load = cls.__batch_loader__
+        if load is not None and columnar:
+            return load(rows, strict)
+        documents, errors = [], {}
+        for row, raw_data in enumerate(rows):
+            try:
+                documents.append(cls.create(raw_data, strict))
+            except Exception, e:
+                documents.append(None)
+                errors[row] = e
+        return documents, errors
+
+    @classmethod
+    def create_trusted(cls, raw_data, strict=True):
+        '''
+        Creates instance from data, which is known to be valid (e.g. read
+        from database), so fields validation is skipped.
+        '''
+        load = cls.__trusted_loader__
+        if load is not None:
+            return load(raw_data, strict)
+        return cls.create(raw_data, strict)
+
+    @classmethod
+    def create_lazy(cls, raw_data, trusted=False):
+        '''
+        Creates instance, which keeps raw data and converts every field only
+        when it's read first time. Unknown fields are ignored.
+        '''
+        if _has_custom_init(cls):
+            if trusted:
+                return cls.create_trusted(raw_data, strict=False)
+            return cls.create(raw_data, strict=False)
+        obj = cls.__new__(cls)
+        obj._data = {}
+        renamed = cls.__renamed_fields__
+        if renamed:
+            obj._raw = dict([(renamed.get(k, k), v)
+                             for k, v in raw_data.iteritems()])
+        else:
+            obj._raw = dict(raw_data)
+        obj._trusted = trusted
+        return obj
+
+    @classmethod
+    def _create(cls, raw_data, strict=True):
         data = {}
         for name, value in raw_data.iteritems():
             try:
@@ -207,7 +749,9 @@ class Collection(object, DocumentMixin):
             except:
                 if strict:
                     raise
-        return cls(**data)
+        document = cls(**data)
+        document.mark_clean()
+        return document
 
     def __str__(self):
         return '<%s: %s>' % (self.collection_name(), self._data)
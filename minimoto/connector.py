@@ -4,34 +4,56 @@
 import motor
 import pymongo
 
+from tornado import gen
 
-_connection = None
-_db = None
 
+DEFAULT_ALIAS = 'default'
 
-class ConnectionError(Exception):
-    pass
-
-
-def current_connection():
-    if _connection is None:
-        raise ConnectionError("Database connection isn't initialised")
-    return _connection
-
+# alias -> connection
+_connections = {}
+# db alias -> (connection alias, db name)
+_databases = {}
+# (db alias, read preference) -> db
+_db_cache = {}
 
-def current_db():
-    if _db is None:
-        raise ConnectionError("Database isn't connected")
 
+class ConnectionError(Exception):
+    pass
 
-def get_connection(**kwargs):
-    global _connection
 
+def current_connection(alias=DEFAULT_ALIAS):
+    connection = _connections.get(alias)
+    if connection is None:
+        raise ConnectionError("Database connection %r isn't initialised" %
+                              (alias,))
+    return connection
+
+
+def current_db(alias=DEFAULT_ALIAS, read_preference=None):
+    '''
+    Returns database registered with `alias`. If `read_preference` is
+    given, returned database object routes queries accordingly.
+    '''
+    key = (alias, read_preference)
+    db = _db_cache.get(key)
+    if db is None:
+        if alias not in _databases:
+            raise ConnectionError("Database %r isn't connected" % (alias,))
+        connection_alias, name = _databases[alias]
+        db = current_connection(connection_alias)[name]
+        if read_preference is not None:
+            db.read_preference = read_preference
+        _db_cache[key] = db
+    return db
+
+
+def get_connection(alias=DEFAULT_ALIAS, **kwargs):
     reconnect = kwargs.pop('reconnect', None)
     if reconnect:
-        disconnect()
-    elif _connection is not None:
-        raise ConnectionError("Database connection has been already created")
+        disconnect(alias)
+    elif alias in _connections:
+        raise ConnectionError("Database connection %r has been already "
+                              "created" % (alias,))
 
     connection_class = kwargs.pop('connection_class', motor.MotorClient)
     if 'replicaSet' in kwargs:
@@ -42,30 +64,76 @@ def get_connection(**kwargs):
             kwargs.pop('replicaSet', None)
         connection_class = kwargs.pop('replica_connection_class',
                                       motor.MotorReplicaSetClient)
+    kwargs.pop('replica_connection_class', None)
+
+    # `pool_size` limits both idle sockets kept by pymongo and concurrent
+    # operations of motor client.
+    pool_size = kwargs.pop('pool_size', None)
+    if pool_size is not None:
+        kwargs.setdefault('max_pool_size', pool_size)
+        if issubclass(connection_class, motor.MotorClientBase):
+            kwargs.setdefault('max_concurrent', pool_size)
     try:
-        _connection = connection_class(**kwargs)
+        connection = connection_class(**kwargs)
     except Exception, e:
         raise ConnectionError("Cannot connect to database: %s" % (e, ))
-    return _connection
-
-
-def disconnect():
-    global _connection
-
-    if _connection is not None:
-        _connection.disconnect()
-        _connection = None
-
-
-def connect(db, **kwargs):
-    global _db
-
-    connection = get_connection(**kwargs)
-    _db = connection[db]
-    return _db
+    _connections[alias] = connection
+    return connection
+
+
+def disconnect(alias=DEFAULT_ALIAS):
+    connection = _connections.pop(alias, None)
+    if connection is not None:
+        connection.disconnect()
+    for db_alias, (connection_alias, _) in _databases.items():
+        if connection_alias == alias:
+            del _databases[db_alias]
+    for key in _db_cache.keys():
+        if key[0] not in _databases:
+            del _db_cache[key]
+
+
+def connect(db, alias=DEFAULT_ALIAS, connection_alias=None, **kwargs):
+    '''
+    Registers database `db` with `alias`. New connection is created, unless
+    `connection_alias` of existing connection is given, e.g.:
+
+        connect('main', host='db1', pool_size=50)
+        connect('analytics', alias='analytics', connection_alias='default')
+    '''
+    if connection_alias is None:
+        connection_alias = alias
+        get_connection(alias=alias, **kwargs)
+    else:
+        current_connection(connection_alias)
+    _databases[alias] = (connection_alias, db)
+    return current_db(alias)
 
 
 def connect_sync(db, **kwargs):
     kwargs['connection_class'] = pymongo.MongoClient
     kwargs['replica_connection_class'] = pymongo.MongoReplicaSetClient
     return connect(db, **kwargs)
+
+
+@gen.engine
+def warm_up(alias=DEFAULT_ALIAS, connections=None, callback=None):
+    '''
+    Opens `connections` sockets (pool size by default) with concurrent
+    pings, so first requests don't pay for connection handshake.
+    '''
+    try:
+        db = current_db(alias)
+        if connections is None:
+            connections = current_connection(_databases[alias][0]) \
+                .max_pool_size or 1
+        if isinstance(db, motor.MotorDatabase):
+            yield [motor.Op(db.command, 'ping') for _ in range(connections)]
+        else:
+            db.command('ping')
+    except Exception, e:
+        if callback is not None:
+            callback(None, e)
+        return
+    if callback is not None:
+        callback(connections, None)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Schema-driven JSON encoder. Fields definitions of collection class are
+used to pick encoder for every field once, so documents are written to
+JSON directly, without intermediate `as_dict` structures. Usage:
+
+    encoder = encoder_for(User)
+    self.write(encoder.encode_list(users))
+
+    # or page by page from streaming `find`
+    stream = User.objects.stream({'active': True}, batch_size=500)
+    count = yield motor.Op(write_json_stream, self, stream)
+'''
+
+import json
+import math
+
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+
+import motor
+
+from bson import ObjectId
+from tornado import gen
+
+from collection import Collection, CollectionMetaClass, inspect_fields, \
+    set_field_name
+from field import Field, BooleanField, ListField, DictField, \
+    EmbeddedDocumentField
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Collection):
+        return value.as_dict()
+    if hasattr(value, 'iteritems'):  # e.g. `RawDocument`
+        return dict(value.iteritems())
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def _encode_any(value):
+    return json.dumps(value, default=_default, separators=(',', ':'))
+
+
+def _encode_int(value):
+    return str(value)
+
+
+def _encode_float(value):
+    if math.isinf(value) or math.isnan(value):
+        return _encode_any(value)
+    return repr(value)
+
+
+def _encode_bool(value):
+    return 'true' if value else 'false'
+
+
+def _encode_object_id(value):
+    return '"%s"' % (value,)
+
+
+def _encode_datetime(value):
+    # timezone-aware values keep their offset, e.g. `+00:00`
+    return '"%s"' % (value.isoformat(),)
+
+
+_TYPE_ENCODERS = [
+    ((unicode, str), encode_basestring_ascii),
+    ((int, long), _encode_int),
+    ((float,), _encode_float),
+    ((bool,), _encode_bool),
+    ((ObjectId,), _encode_object_id),
+    ((datetime,), _encode_datetime),
+]
+
+
+def _document_encoder(document_type, exclude_unset=False):
+    def encode(value):
+        if value is None:
+            return 'null'
+        return encoder_for(document_type, exclude_unset).encode(value)
+    return encode
+
+
+def _type_encoder(item_type, exclude_unset=False):
+    '''
+    Returns types of values and their encoder. Values of other types (e.g.
+    `None` or not validated values) are encoded by generic encoder. If
+    types are `None`, encoder accepts any value.
+    '''
+    if item_type is None:
+        return None, _encode_any
+    if isinstance(item_type, CollectionMetaClass):
+        return None, _document_encoder(item_type, exclude_unset)
+    for types, encode in _TYPE_ENCODERS:
+        if issubclass(item_type, types):
+            return types, encode
+    return None, _encode_any
+
+
+def _any_type(types, encode):
+    if types is None:
+        return encode
+    return lambda value: encode(value) if type(value) in types \
+        else _encode_any(value)
+
+
+def _field_encoder(field, exclude_unset=False):
+    # nested documents are dumped with the same `exclude_unset` as their
+    # owner, except values of `DictField` (see `Collection.as_dict`)
+    if isinstance(field, EmbeddedDocumentField):
+        return None, _document_encoder(field.document_type, exclude_unset)
+    if isinstance(field, ListField):
+        encode_item = _any_type(*_type_encoder(field.item_type,
+                                               exclude_unset))
+        return (list,), lambda value: '[%s]' % ','.join(
+            map(encode_item, value))
+    if isinstance(field, DictField):
+        encode_item = _any_type(*_type_encoder(field.item_type))
+        return (dict,), lambda value: '{%s}' % ','.join(
+            [encode_basestring_ascii(k) + ':' + encode_item(v)
+             for k, v in value.iteritems()])
+    if isinstance(field, BooleanField):
+        return (bool,), _encode_bool
+    return _type_encoder(field.field_type)
+
+
+class DocumentEncoder(object):
+    '''
+    JSON encoder of `collection_class` documents. Output is the same as of
+    `json.dumps(document.as_dict())` with `ObjectId` and `datetime` (in ISO
+    format) support. Plain dicts and `RawDocument` views are accepted too.
+    '''
+
+    def __init__(self, collection_class, exclude_unset=False):
+        self.collection_class = collection_class
+        self.exclude_unset = exclude_unset
+        self.fields = []
+        # attribute name -> (key, encoder), mappings (e.g. `as_dict()` or
+        # stored documents) are keyed by attribute names
+        self.by_name = {}
+        for name, field in inspect_fields(collection_class).iteritems():
+            key = encode_basestring_ascii(name) + ':'
+            types, encode = _field_encoder(field, exclude_unset)
+            # loaded values of plain fields can be read without descriptor
+            plain = type(field).__get__.im_func is Field.__get__.im_func
+            self.fields.append((name, field.name,
+                                set_field_name(collection_class, field),
+                                field.required, field.__get__, plain, key,
+                                types, encode))
+            self.by_name[name] = (key, _any_type(types, encode))
+
+    def encode(self, document):
+        if document is None:
+            return 'null'
+        if not isinstance(document, Collection):
+            return self.encode_mapping(document)
+        collection_class = self.collection_class
+        exclude_unset = self.exclude_unset
+        data = document._data
+        loaded = document._loaded
+        parts = []
+        for name, field_name, set_name, required, get, plain, key, types, \
+                encode in self.fields:
+            if plain and field_name in data:
+                value = data[field_name]
+            else:
+                if loaded is not None and field_name not in loaded and \
+                        field_name not in data and set_name not in loaded \
+                        and set_name not in data:
+                    continue  # not loaded due to projection
+                value = get(document, collection_class)
+                if exclude_unset and not required and \
+                        set_name not in data:
+                    continue
+            # Because we don't want pass empty `_id` to client code
+            if name == '_id' and not value:
+                continue
+            if types is None or type(value) in types:
+                parts.append(key + encode(value))
+            else:
+                parts.append(key + _encode_any(value))
+        return '{%s}' % ','.join(parts)
+
+    def encode_mapping(self, document):
+        by_name = self.by_name
+        parts = []
+        for name, value in document.iteritems():
+            known = by_name.get(name)
+            if known is None:
+                parts.append(encode_basestring_ascii(name) + ':' +
+                             _encode_any(value))
+            else:
+                parts.append(known[0] + known[1](value))
+        return '{%s}' % ','.join(parts)
+
+    def encode_many(self, documents):
+        '''
+        Returns comma separated documents, i.e. part of JSON array.
+        '''
+        return ','.join(map(self.encode, documents))
+
+    def encode_list(self, documents):
+        return '[%s]' % self.encode_many(documents)
+
+    def iter_encode(self, documents, batch_size=100):
+        '''
+        Yields JSON array in chunks of `batch_size` documents.
+        '''
+        yield '['
+        batch = []
+        first = True
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield ('' if first else ',') + self.encode_many(batch)
+                first = False
+                batch = []
+        if batch:
+            yield ('' if first else ',') + self.encode_many(batch)
+        yield ']'
+
+
+_encoders = {}
+
+
+def encoder_for(collection_class, exclude_unset=False):
+    '''
+    Returns cached encoder of `collection_class` documents.
+    '''
+    encoder = _encoders.get((collection_class, exclude_unset))
+    if encoder is None:
+        encoder = _encoders[(collection_class, exclude_unset)] = \
+            DocumentEncoder(collection_class, exclude_unset)
+    return encoder
+
+
+@gen.engine
+def write_json_stream(writer, stream, encoder=None, callback=None):
+    '''
+    Writes documents of `MotorStream` as JSON array to `writer` (e.g.
+    `RequestHandler`) and flushes it after every batch, so memory is
+    bounded by batch size. Result is number of written documents.
+    '''
+    if encoder is None:
+        encoder = encoder_for(stream.manager.collection)
+    count = 0
+    try:
+        writer.write('[')
+        while True:
+            batch = yield motor.Op(stream.next_batch)
+            if not batch:
+                break
+            writer.write(('' if not count else ',') +
+                         encoder.encode_many(batch))
+            count += len(batch)
+            yield gen.Task(writer.flush)
+        writer.write(']')
+    except Exception, e:
+        stream.close()
+        if callback is not None:
+            callback(None, e)
+        return
+    if callback is not None:
+        callback(count, None)
@@ -4,6 +4,13 @@ from dateutil import tz
 from datetime import datetime
 from bson import ObjectId
 
+from utils import normalize_text
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def show_help(class_or_obj):
     # to avoid cyclic imports
@@ -38,6 +45,33 @@ def _ensure_parent(item, parent, _meta_field='__parent__'):
     return item
 
 
+def _load_document(document_type, value, parent, trusted=False):
+    '''
+    Creates lazy embedded document from raw dict.
+    '''
+    return _ensure_parent(
+        document_type.create_lazy(value, trusted=trusted), parent)
+
+
+class PartialDocumentError(Exception):
+    '''
+    Raised on read of field, which was not loaded due to projection.
+    '''
+
+
+class BatchValidationError(ValueError):
+    '''
+    Raised when some documents of batch are invalid, `errors` maps row
+    index to error.
+    '''
+    def __init__(self, errors):
+        self.errors = errors
+        rows = sorted(errors)
+        super(BatchValidationError, self).__init__(
+            '%d invalid documents in batch, first is #%d: %s' %
+            (len(rows), rows[0], errors[rows[0]]))
+
+
 class _Default(object):
     __slots__ = ()
     __nonzero__ = lambda self: False
@@ -92,20 +126,107 @@ class Field(object):
 
         return value
 
+    def validate_column(self, values, objs=None):
+        '''
+        Validates values of field for batch of documents (`objs` are their
+        owners). Returns list of converted values and dict of errors by
+        position, invalid values are replaced by `None`.
+
+        If field has plain `validate`, type, choices and constraints are
+        checked for the whole column, and only suspicious values are passed
+        to `validate` to get conversion or error.
+        '''
+        values = list(values)
+        if type(self).validate.im_func not in _COLUMNAR or self.validators:
+            positions = range(len(values))
+        else:
+            positions = self.column_violations(values)
+        errors = {}
+        validate = self.validate
+        for i in positions:
+            try:
+                values[i] = validate(values[i], objs[i] if objs else None)
+            except Exception, e:
+                values[i] = None
+                errors[i] = e
+        return values, errors
+
+    def column_violations(self, values):
+        '''
+        Returns positions of values, which cannot be accepted as is.
+        '''
+        exact = _exact_types(self.field_type)
+        violations, rows = [], []
+        for i, value in enumerate(values):
+            if value is None:
+                if self.required:
+                    violations.append(i)
+            elif exact is None or type(value) in exact:
+                rows.append(i)
+            else:  # needs type conversion
+                violations.append(i)
+        if rows and self.choices:
+            try:
+                choices = frozenset(self.choices)
+            except TypeError:
+                choices = self.choices
+            violations.extend(
+                [i for i in rows if _not_in(values[i], choices)])
+        if rows:
+            violations.extend(self.check_column([values[i] for i in rows],
+                                                rows))
+        return sorted(set(violations))
+
+    def check_column(self, column, rows):
+        '''
+        Checks field constraints for values of exact type. Returns
+        positions (from `rows`) of values, which violate constraints.
+        '''
+        return []
+
+    def load(self, value, obj=None, trusted=False):
+        '''
+        Converts raw value read from database. Trusted values are used as
+        is, because they were validated on write.
+        '''
+        if trusted:
+            return value
+        return self.validate(value, obj)
+
     def __get__(self, obj, objtype=None):
         if obj is None:
             return self
         value = obj._data.get(self.name, _DEFAULT)
         if value is _DEFAULT:
+            # lazy document keeps raw data until field is read first time
+            raw = getattr(obj, '_raw', None)
+            if raw and self.name in raw:
+                value = self.load(raw.pop(self.name), obj, obj._trusted)
+                obj._data[self.name] = value
+                return value
+            loaded = getattr(obj, '_loaded', None)
+            if loaded is not None and self.name not in loaded:
+                raise PartialDocumentError(
+                    'Field "%s" was not loaded.' % (self.name,))
             if self.default is _DEFAULT:
                 return None
             value = self.default() if callable(self.default) else self.default
             if not isinstance(value, _IMMUTABLE_TYPES):
-                self.__set__(obj, value)
+                # default isn't a change, so it's not marked as dirty
+                value = obj._data[self.name] = self.validate(value, obj)
         return value
 
     def __set__(self, obj, value):
         obj._data[self.name] = self.validate(value, obj)
+        raw = getattr(obj, '_raw', None)
+        if raw:
+            raw.pop(self.name, None)
+        # track changes for partial updates
+        dirty = getattr(obj, '_dirty', None)
+        if dirty is None:
+            obj._dirty = set([self.name])
+        else:
+            dirty.add(self.name)
 
     def __str__(self):
         type_name = getattr(self.field_type, '__name__', self.field_type)
@@ -163,6 +284,43 @@ class StringField(Field):
                 pass
         return value
 
+    def check_column(self, column, rows):
+        violations = []
+        if self.max_length is not None or self.min_length is not None:
+            lengths = map(len, column)
+            violations.extend(_out_of_range(lengths, rows, self.min_length,
+                                            self.max_length))
+        if self.regex is not None:
+            match = self.regex.match
+            violations.extend([i for i, value in zip(rows, column)
+                               if match(value) is None])
+        return violations
+
+
+class NormalizedField(StringField):
+    '''
+    Shadow of `source` string field (attribute name) with normalized value
+    (see `normalize_text`), which is stored for prefix search by index
+    (see `MotorManager.autocomplete`). Value is computed from source field,
+    and it's marked as changed together with source, e.g.:
+
+        name = StringField()
+        name_key = NormalizedField('name')
+    '''
+
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        super(NormalizedField, self).__init__(*args, **kwargs)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            value = getattr(obj, self.source)
+        except PartialDocumentError:  # stored value is the only one
+            return super(NormalizedField, self).__get__(obj, objtype)
+        return normalize_text(value)
+
 
 class NumberField(Field):
 
@@ -183,6 +341,11 @@ class NumberField(Field):
                     (self.name, self.max_value))
         return value
 
+    def check_column(self, column, rows):
+        if self.min_value is None and self.max_value is None:
+            return []
+        return _out_of_range(column, rows, self.min_value, self.max_value)
+
 
 class IntegerField(NumberField):
     '''
@@ -244,8 +407,7 @@ class DateTimeField(Field):
         if self.auto_now:
             value = self.utcnow()
         elif value is None and self.auto_created:
-            value = self.utcnow()
-            self.__set__(obj, value)
+            value = obj._data[self.name] = self.utcnow()
         return value
 
 
@@ -279,6 +441,18 @@ class ListField(Field):
             raise ValueError('List item for "%s" field must be %s, not %s.' %
                              (self.name, self.item_type, type(item)))
 
+    def load(self, value, obj=None, trusted=False):
+        if value is None or not hasattr(self.item_type, 'create_lazy'):
+            return super(ListField, self).load(value, obj, trusted)
+        if not trusted:
+            value = Field.validate(self, value, obj)
+        return [self.load_item(v, obj, trusted) for v in value]
+
+    def load_item(self, item, obj=None, trusted=False):
+        if isinstance(item, dict):
+            return _load_document(self.item_type, item, obj, trusted)
+        return item if trusted else self.validate_item(item, obj)
+
 
 class EmbeddedDocumentField(Field):
 
@@ -301,6 +475,13 @@ class EmbeddedDocumentField(Field):
             value = _ensure_parent(value, obj)
         return value
 
+    def load(self, value, obj=None, trusted=False):
+        if not isinstance(value, dict):
+            return super(EmbeddedDocumentField, self).load(value, obj, trusted)
+        if not trusted:
+            value = Field.validate(self, value, obj)
+        return _load_document(self.document_type, value, obj, trusted)
+
     def __get__(self, obj, objtype=None):
         #TODO: required some magic to get document value instead field
         value = super(EmbeddedDocumentField, self).__get__(obj, objtype=objtype)
@@ -333,9 +514,76 @@ class DictField(Field):
             raise ValueError('Dict value for "%s" field must be %s, not %s.' %
                              (self.name, self.item_type, type(item)))
 
+    def load(self, value, obj=None, trusted=False):
+        if not hasattr(value, 'iteritems') or \
+                not hasattr(self.item_type, 'create_lazy'):
+            return super(DictField, self).load(value, obj, trusted)
+        if not trusted:
+            value = Field.validate(self, value, obj)
+        return dict([(k, self.load_item(k, v, obj, trusted))
+                     for k, v in value.iteritems()])
+
+    def load_item(self, key, item, obj=None, trusted=False):
+        if isinstance(item, dict):
+            return _load_document(self.item_type, item, obj, trusted)
+        return item if trusted else self.validate_item(key, item, obj)
+
 ObjectField = DictField
 
 
 class ObjectIdField(Field):
 
     field_type = ObjectId
+
+
+# `validate` implementations, which can be replaced by column checks
+_COLUMNAR = (Field.validate.im_func, StringField.validate.im_func,
+             NumberField.validate.im_func)
+
+# NumPy pays for conversion of python list, so it's used for big columns
+NUMPY_MIN_SIZE = 10000
+
+
+def _exact_types(field_type):
+    '''
+    Returns types of values accepted by `Field.validate` without conversion,
+    or `None` if any value is accepted.
+    '''
+    if field_type is None:
+        return None
+    if field_type in (int, long):
+        return (int, long)
+    if field_type is unicode:
+        return (unicode,)  # `str` is decoded by `StringField`
+    return (field_type,)
+
+
+def _not_in(value, choices):
+    try:
+        return value not in choices
+    except TypeError:  # unhashable value, `validate` reports it
+        return True
+
+
+def _out_of_range(column, rows, low, high):
+    '''
+    Returns positions (from `rows`) of values out of [low, high] range.
+    '''
+    if numpy is not None and len(column) >= NUMPY_MIN_SIZE:
+        try:
+            array = numpy.asarray(column)
+            mask = numpy.zeros(len(column), dtype=bool)
+            if low is not None:
+                mask |= array < low
+            if high is not None:
+                mask |= array > high
+            return [rows[i] for i in numpy.flatnonzero(mask)]
+        except (TypeError, ValueError, OverflowError):
+            pass
+    # fast path for column without violations
+    if (low is None or min(column) >= low) and \
+            (high is None or max(column) <= high):
+        return []
+    return [i for i, value in zip(rows, column)
+            if (low is not None and value < low) or
+            (high is not None and value > high)]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import functools
+import threading
+
+from tornado import stack_context
+
+
+__all__ = ['IdentityMap', 'identity_map', 'unit_of_work',
+           'current_identity_map', ]
+
+
+_state = threading.local()
+
+
+def current_identity_map():
+    return getattr(_state, 'identity_map', None)
+
+
+class IdentityMap(object):
+    '''
+    Keeps one instance per document `_id` within unit of work (usually one
+    request), so documents found several times are same objects.
+    '''
+
+    def __init__(self):
+        self._documents = {}
+
+    def get(self, collection_class, _id):
+        if _id is None:
+            return None
+        return self._documents.get((collection_class, _id))
+
+    def add(self, document):
+        '''
+        Registers document and returns instance, which should be used
+        instead of it (already registered one, if any).
+        '''
+        # lazy documents keep `_id` in raw data until it's read
+        _id = getattr(document, '_id', None) if document is not None \
+            else None
+        if _id is None:
+            return document
+        key = (document.__class__, _id)
+        return self._documents.setdefault(key, document)
+
+    def register(self, documents):
+        if isinstance(documents, list):
+            return [self.add(x) for x in documents]
+        return self.add(documents)
+
+    def discard(self, collection_class=None):
+        if collection_class is None:
+            self._documents.clear()
+            return
+        for key in self._documents.keys():
+            if key[0] is collection_class:
+                del self._documents[key]
+
+    def __len__(self):
+        return len(self._documents)
+
+    @contextlib.contextmanager
+    def activate(self):
+        previous = current_identity_map()
+        _state.identity_map = self
+        try:
+            yield self
+        finally:
+            _state.identity_map = previous
+
+
+def identity_map(imap=None):
+    '''
+    Returns stack context, which makes identity map current for all code
+    and callbacks executed within it.
+    Usage:
+
+        with identity_map():
+            User.objects.find_one(user_id, callback=on_user)
+    '''
+    if imap is None:
+        imap = IdentityMap()
+    return stack_context.StackContext(imap.activate)
+
+
+def unit_of_work(method):
+    '''
+    Decorator to run method (e.g. request handler one) with own identity map.
+    It must be applied on top of `gen.engine`, because yield within `with
+    StackContext` block is not allowed:
+
+        @unit_of_work
+        @gen.engine
+        def get(self):
+            ...
+    '''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        # callback should be executed in caller context
+        if kwargs.get('callback') is not None:
+            kwargs['callback'] = stack_context.wrap(kwargs['callback'])
+        with identity_map():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def lookup_id(args, kwargs):
+    '''
+    Returns `_id` if `find_one` arguments are a lookup by `_id` only.
+    '''
+    spec = args[0] if args else kwargs.get('spec_or_id')
+    if spec is None:
+        return None
+    if not isinstance(spec, dict):
+        return spec
+    if len(spec) == 1 and not isinstance(spec.get('_id', {}), dict):
+        return spec['_id']
+    return None
+
+
+def is_projected(args, kwargs):
+    return (len(args) > 1 and args[1] is not None) or \
+        kwargs.get('fields') is not None
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import motor
+
+from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+from utils import maybe_multi, _get_path
+
+
+__all__ = ['Loader', ]
+
+
+class Loader(object):
+    '''
+    Collects lookups by `key` field made within one IOLoop iteration and
+    loads them with single `{key: {'$in': [...]}}` query. Every caller gets
+    document with requested key value or `None`.
+    Usage:
+
+        user = yield motor.Op(User.objects.load, user_id)
+        users = yield motor.Op(User.objects.loader('email').load_many, emails)
+    '''
+
+    def __init__(self, manager, key='_id', max_batch_size=1000, io_loop=None,
+                 **find_kwargs):
+        self.manager = manager
+        self.key = key
+        self.max_batch_size = max_batch_size
+        self.io_loop = io_loop or IOLoop.instance()
+        self.find_kwargs = find_kwargs
+        self._pending = {}
+        self._scheduled = False
+
+    def load(self, value, callback):
+        self._pending.setdefault(value, []).append(
+            stack_context.wrap(callback))
+        if not self._scheduled:
+            self._scheduled = True
+            # batch doesn't belong to context of any particular caller
+            with stack_context.NullContext():
+                self.io_loop.add_callback(self.dispatch)
+
+    def load_many(self, values, callback):
+        values = list(values)
+        if not values:
+            callback([], None)
+            return
+        results = [None] * len(values)
+        state = {'left': len(values), 'failed': False}
+
+        def on_load(index):
+            def done(document, error):
+                if state['failed']:
+                    return
+                if error is not None:
+                    state['failed'] = True
+                    callback(None, error)
+                    return
+                results[index] = document
+                state['left'] -= 1
+                if not state['left']:
+                    callback(results, None)
+            return done
+
+        for index, value in enumerate(values):
+            self.load(value, on_load(index))
+
+    def dispatch(self):
+        pending, self._pending = self._pending, {}
+        self._scheduled = False
+        values = pending.keys()
+        for offset in range(0, len(values), self.max_batch_size):
+            chunk = values[offset:offset + self.max_batch_size]
+            self._load_batch(dict([(v, pending[v]) for v in chunk]))
+
+    @gen.engine
+    def _load_batch(self, pending):
+        try:
+            documents = yield motor.Op(
+                self.manager.find, {self.key: maybe_multi(pending.keys())},
+                **self.find_kwargs)
+        except Exception, e:
+            for callbacks in pending.itervalues():
+                [_notify(callback, None, e) for callback in callbacks]
+            return
+        found = {}
+        for document in documents:
+            found.setdefault(_get_path(document, self.key), document)
+        for value, callbacks in pending.iteritems():
+            document = found.get(value)
+            [_notify(callback, document, None) for callback in callbacks]
+
+
+def _notify(callback, result, error):
+    '''
+    Calls callback of one lookup, so its failure doesn't prevent other
+    callbacks of batch from being called.
+    '''
+    try:
+        callback(result, error)
+    except Exception:
+        logging.error('Exception in load callback', exc_info=True)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Load-test harness for managers. Many concurrent coroutines run configurable
+mix of operations against local mongod or in-process fake database and
+throughput, p50/p99 latency and IOLoop lag are reported. Usage:
+
+    python -m minimoto.loadtest --concurrency 200 --duration 10
+    python -m minimoto.loadtest --mongo localhost:27017 --db loadtest
+    python -m minimoto.loadtest --max-p99 0.05  # exits with 1 if slower
+
+Also `run_load()` can be used from regression checks.
+'''
+
+import sys
+import time
+import random
+import argparse
+import functools
+import itertools
+
+import motor
+
+from bson import ObjectId
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import connector
+from collection import Collection
+from field import StringField, IntegerField, ObjectIdField
+
+
+LOAD_ALIAS = 'loadtest'
+
+
+class LoadItem(Collection):
+    __collection__ = 'loadtest_items'
+    __db_alias__ = LOAD_ALIAS
+
+    _id = ObjectIdField()
+    key = IntegerField()
+    name = StringField()
+    counter = IntegerField(default=0)
+
+
+#
+# In-process stand-in for motor database. It supports only subset of motor
+# API used by managers, and only equality and `$in` conditions in specs.
+#
+
+def _match(document, spec):
+    if spec is None:
+        return True
+    if not isinstance(spec, dict):
+        spec = {'_id': spec}
+    for key, condition in spec.iteritems():
+        value = document.get(key)
+        if isinstance(condition, dict) and '$in' in condition:
+            if value not in condition['$in']:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor(object):
+
+    def __init__(self, collection, spec=None, fields=None):
+        self.collection = collection
+        self.spec = spec
+        self._skip = 0
+        self._limit = 0
+        self._documents = None
+        self.alive = True
+
+    def _results(self):
+        if self._documents is None:
+            documents = [dict(x) for x in self.collection.documents.values()
+                         if _match(x, self.spec)]
+            documents = documents[self._skip:]
+            if self._limit:
+                documents = documents[:self._limit]
+            self._documents = documents
+        return self._documents
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def to_list(self, length=None, callback=None):
+        self.collection.respond(callback, self._results())
+
+    def count(self, callback=None):
+        self.collection.respond(callback, len(self._results()))
+
+    @property
+    def fetch_next(self):
+        return gen.Task(self._fetch_next)
+
+    def _fetch_next(self, callback):
+        self.collection.respond(lambda r, e: callback(r),
+                                bool(self._results()))
+
+    def next_object(self):
+        return self._results().pop(0)
+
+    def close(self, callback=None):
+        self.alive = False
+
+
+class FakeCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.documents = {}
+
+    def respond(self, callback, result, error=None):
+        self.database.respond(callback, result, error)
+
+    def find(self, spec=None, fields=None, **kwargs):
+        return FakeCursor(self, spec, fields)
+
+    def find_one(self, spec_or_id=None, fields=None, callback=None, **kwargs):
+        result = None
+        for document in self.documents.itervalues():
+            if _match(document, spec_or_id):
+                result = dict(document)
+                break
+        self.respond(callback, result)
+
+    def insert(self, doc_or_docs, callback=None, **kwargs):
+        documents = doc_or_docs
+        if not isinstance(documents, list):
+            documents = [documents]
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            self.documents[document['_id']] = dict(document)
+        ids = [x['_id'] for x in documents]
+        self.respond(callback, ids if isinstance(doc_or_docs, list)
+                     else ids[0])
+
+    def save(self, to_save, callback=None, **kwargs):
+        to_save.setdefault('_id', ObjectId())
+        self.documents[to_save['_id']] = dict(to_save)
+        self.respond(callback, to_save['_id'])
+
+    def update(self, spec, document, upsert=False, multi=False,
+               callback=None, **kwargs):
+        n = self._update(spec, document, multi)
+        self.respond(callback, {'ok': 1, 'n': n})
+
+    def _update(self, spec, document, multi=False):
+        n = 0
+        for _id, current in self.documents.items():
+            if not _match(current, spec):
+                continue
+            if '$set' in document or '$inc' in document:
+                current.update(document.get('$set', {}))
+                for key, value in document.get('$inc', {}).iteritems():
+                    current[key] = current.get(key, 0) + value
+            else:
+                self.documents[_id] = dict(document, _id=_id)
+            n += 1
+            if not multi:
+                break
+        return n
+
+    def remove(self, spec_or_id=None, callback=None, **kwargs):
+        n = self._remove(spec_or_id)
+        self.respond(callback, {'ok': 1, 'n': n})
+
+    def _remove(self, spec, limit=0):
+        removed = [k for k, v in self.documents.iteritems()
+                   if _match(v, spec)]
+        if limit:
+            removed = removed[:limit]
+        for _id in removed:
+            del self.documents[_id]
+        return len(removed)
+
+
+class FakeDatabase(object):
+
+    def __init__(self, name, latency=0):
+        self.name = name
+        self.latency = latency
+        self.read_preference = None
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+    def command(self, command, *args, **kwargs):
+        callback = kwargs.pop('callback', None)
+        name = command.keys()[0] if isinstance(command, dict) else command
+        if name == 'collstats':
+            result = {'count': len(self[args[0]].documents)}
+        elif name in ('insert', 'update', 'delete'):
+            result = self._write_command(name, command)
+        else:
+            result = {'ok': 1}
+        self.respond(callback, result)
+
+    def _write_command(self, name, command):
+        collection = self[command[name]]
+        n = 0
+        if name == 'insert':
+            for document in command['documents']:
+                collection.documents[document['_id']] = dict(document)
+                n += 1
+        elif name == 'update':
+            for update in command['updates']:
+                n += collection._update(update['q'], update['u'],
+                                        update.get('multi'))
+        else:
+            for delete in command['deletes']:
+                n += collection._remove(delete['q'], delete.get('limit'))
+        return {'ok': 1, 'n': n}
+
+    def respond(self, callback, result, error=None):
+        if callback is None:
+            return
+        if self.latency:
+            IOLoop.instance().add_timeout(
+                time.time() + self.latency,
+                functools.partial(callback, result, error))
+        else:
+            IOLoop.instance().add_callback(
+                functools.partial(callback, result, error))
+
+
+class FakeClient(object):
+    '''
+    Connection class for `connector.connect`, e.g.:
+
+        connect('test', connection_class=FakeClient, latency=0.001)
+    '''
+
+    def __init__(self, latency=0, **kwargs):
+        self.latency = latency
+        self._databases = {}
+
+    def __getitem__(self, name):
+        if name not in self._databases:
+            self._databases[name] = FakeDatabase(name, self.latency)
+        return self._databases[name]
+
+    def disconnect(self):
+        self._databases = {}
+
+
+#
+# Load generator
+#
+
+OPERATIONS = {
+    'find': lambda key: motor.Op(
+        LoadItem.objects.find, {'key': {'$in': [key, key + 1]}}),
+    'find_one': lambda key: motor.Op(
+        LoadItem.objects.find_one, {'key': key}),
+    'insert': lambda key: motor.Op(
+        LoadItem.objects.insert, {'key': key, 'name': u'item %d' % key}),
+    'update': lambda key: motor.Op(
+        LoadItem.objects.update, {'key': key}, {'$inc': {'counter': 1}}),
+    'count': lambda key: motor.Op(
+        LoadItem.objects.count, {'key': key}),
+}
+
+DEFAULT_MIX = 'find=3,find_one=10,insert=2,update=2,count=1'
+
+
+def parse_mix(mix):
+    '''
+    Usage:
+    >>> parse_mix('find=1,insert=2')
+    [('find', 1), ('insert', 2)]
+    '''
+    result = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise ValueError('Unknown operation "%s".' % (name,))
+        result.append((name, int(weight or 1)))
+    return result
+
+
+def percentile(samples, percent):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    index = int(round((len(samples) - 1) * percent / 100.0))
+    return samples[index]
+
+
+def summary(samples):
+    return {
+        'count': len(samples),
+        'p50': percentile(samples, 50),
+        'p99': percentile(samples, 99),
+        'max': max(samples) if samples else None,
+    }
+
+
+@gen.engine
+def _prepare(keys, callback):
+    yield motor.Op(LoadItem.objects.remove, {})
+    yield motor.Op(LoadItem.objects.insert_many,
+                   [{'key': i, 'name': u'item %d' % i} for i in range(keys)],
+                   ordered=False)
+    callback()
+
+
+@gen.engine
+def _worker(mix, keys, deadline, latencies, errors, seed, callback):
+    rnd = random.Random(seed)
+    names = list(itertools.chain(*[[n] * w for n, w in mix]))
+    while time.time() < deadline:
+        name = rnd.choice(names)
+        started = time.time()
+        try:
+            yield OPERATIONS[name](rnd.randint(0, keys - 1))
+        except Exception:
+            errors[name] = errors.get(name, 0) + 1
+        latencies.setdefault(name, []).append(time.time() - started)
+    callback()
+
+
+@gen.engine
+def _lag_monitor(deadline, samples, interval, callback):
+    io_loop = IOLoop.instance()
+    while time.time() < deadline:
+        expected = time.time() + interval
+        yield gen.Task(io_loop.add_timeout, expected)
+        samples.append(max(0.0, time.time() - expected))
+    callback()
+
+
+@gen.engine
+def _run(concurrency, duration, mix, keys, prepare, callback):
+    if prepare:
+        yield gen.Task(_prepare, keys)
+    latencies, errors, lag = {}, {}, []
+    started = time.time()
+    deadline = started + duration
+    tasks = [gen.Task(_worker, mix, keys, deadline, latencies, errors, i)
+             for i in range(concurrency)]
+    tasks.append(gen.Task(_lag_monitor, deadline, lag, 0.01))
+    yield tasks
+    elapsed = time.time() - started
+    total = sum([len(x) for x in latencies.values()])
+    callback({
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'throughput': total / elapsed,
+        'errors': errors,
+        'operations': dict([(k, summary(v))
+                            for k, v in latencies.iteritems()]),
+        'all': summary(list(itertools.chain(*latencies.values()))),
+        'ioloop_lag': summary(lag),
+    })
+
+
+def run_load(concurrency=100, duration=5.0, mix=DEFAULT_MIX, keys=1000,
+             prepare=True):
+    '''
+    Runs load test on `LoadItem` collection of database registered with
+    `LOAD_ALIAS` and returns results dict. IOLoop must not be running.
+    '''
+    result = {}
+    io_loop = IOLoop.instance()
+
+    def done(value):
+        result.update(value)
+        io_loop.stop()
+    _run(concurrency, duration, parse_mix(mix), keys, prepare,
+         callback=done)
+    io_loop.start()
+    return result
+
+
+def _format(result, out=sys.stdout):
+    ms = lambda x: '%8.2fms' % (x * 1000) if x is not None else '       -'
+    out.write('concurrency: %(concurrency)d, duration: %(duration).1fs, '
+              'throughput: %(throughput).1f ops/s\n' % result)
+    rows = sorted(result['operations'].items()) + [
+        ('all', result['all']), ('ioloop lag', result['ioloop_lag'])]
+    for name, data in rows:
+        out.write('%-12s %8d %s %s %s %s\n' % (
+            name, data['count'], ms(data['p50']), ms(data['p99']),
+            ms(data['max']), result['errors'].get(name, '')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--mongo', help='host:port of mongod, in-process '
+                        'fake database is used if not given')
+    parser.add_argument('--db', default='minimoto_loadtest')
+    parser.add_argument('--pool-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated latency of fake database')
+    parser.add_argument('--max-p99', type=float,
+                        help='fail if p99 latency (seconds) is greater')
+    args = parser.parse_args(argv)
+
+    if args.mongo:
+        host, _, port = args.mongo.partition(':')
+        connection = connector.get_connection(
+            alias=LOAD_ALIAS, host=host, port=int(port or 27017),
+            pool_size=args.pool_size)
+        connection.open_sync()
+        connector.connect(args.db, alias=LOAD_ALIAS,
+                          connection_alias=LOAD_ALIAS)
+    else:
+        connector.connect(args.db, alias=LOAD_ALIAS,
+                          connection_class=FakeClient, latency=args.latency)
+
+    result = run_load(args.concurrency, args.duration, args.mix, args.keys)
+    _format(result)
+    if args.max_p99 is not None and result['all']['p99'] > args.max_p99:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,8 @@
 
 from __future__ import absolute_import
 
+import copy
+import time
 import logging
 import contextlib
 import functools
@@ -10,11 +12,23 @@ import motor
 
 from tornado import gen
 from tornado import stack_context
+from tornado.concurrent import TracebackFuture
 
-from connector import current_db
+from connector import current_db, DEFAULT_ALIAS
+from cache import TTLCache, LRUCache
+from bulk import BulkWriter, WriteBehind, WriteQueue
+from identity import current_identity_map, lookup_id, is_projected
+from loader import Loader
+from field import BatchValidationError
+from raw import RawDocument, raw_collection, is_tz_aware
+from aggregation import Aggregation
+import metrics
+from utils import query_key, find_projection, optimistic_async, \
+    ConflictError, model_fields, text_query, match_exact, match_prefix
 
 
-__all__ = ['safe_motor', 'BaseManager', 'MotorManager', 'MotorOp', ]
+__all__ = ['safe_motor', 'BaseManager', 'MotorManager', 'MotorOp',
+           'MotorStream', 'FutureManager', 'FutureStream', 'return_future', ]
 
 
 def safe_motor(async_func):
@@ -43,32 +57,43 @@ def safe_motor(async_func):
 
 class MotorOp(object):
 
-    def __init__(self, action, qualifier=None, modifier=None, as_model=False, hard=False):
+    def __init__(self, action, qualifier=None, modifier=None, as_model=False,
+                 hard=False, invalidate=False, cacheable=False):
         self.action = action
         self.qualifier = qualifier
         self.modifier = modifier
         self.as_model = as_model
         self.hard = hard
+        # whether operation changes data, so manager caches become stale
+        self.invalidate = invalidate
+        # whether result can be kept in manager read-through cache
+        self.cacheable = cacheable
 
-    @gen.engine
-    def execute(self, manager, *args, **kwargs):
-        assert 'callback' in kwargs
-        callback = kwargs.pop('callback')
-        modifier = kwargs.pop('modifier', self.modifier)
-        as_model = kwargs.pop('as_model', self.as_model)
-        hard = kwargs.pop('hard', self.hard)
-
+    def cache_key(self, manager, db, modifier, args, kwargs):
+        '''
+        Returns key of query in manager cache, or `None` if query result
+        cannot be cached.
+        '''
+        if not self.cacheable or manager.cache is None:
+            return None
+        modifier_key = None
+        if modifier is not None:
+            modifier_key = getattr(modifier, 'cache_key', None)
+            if modifier_key is None:
+                return None
         try:
-            db = kwargs.pop('db', None)
-            if db is None:
-                db = current_db()
-            dbc = db[manager.collection_name]
+            return query_key(getattr(db, 'name', None), self.action,
+                             args, kwargs, modifier_key)
+        except TypeError:  # not serializable query
+            return None
 
+    def query(self, dbc, modifier, *args, **kwargs):
+        callback = kwargs.pop('callback')
+        try:
             # We assumed if `qualifier` is not given, that action doesn't
             # return cursor and should be executed asynchronously
             if not self.qualifier:
-                result = yield motor.Op(
-                    getattr(dbc, self.action), *args, **kwargs)
+                getattr(dbc, self.action)(*args, callback=callback, **kwargs)
 
             else:
                 cursor = getattr(dbc, self.action)(*args, **kwargs)
@@ -78,39 +103,320 @@ class MotorOp(object):
                     modified_cursor = modifier(cursor)
                     if modified_cursor:
                         cursor = modified_cursor
-                result = yield motor.Op(getattr(cursor, self.qualifier))
-
-            # Unfortunately we cannot use `as class` option for auto conversion
-            # to model class, because mongo uses same class for top-level and
-            # inner documents.
-            if as_model:
-                if isinstance(result, (list, tuple, set)):
-                    result = manager.create(result)
-                else:
-                    result = manager.create_one(result, hard=hard)
-
-            callback(result, None)
+                getattr(cursor, self.qualifier)(callback=callback)
         except Exception, e:
             callback(None, e)
 
+    def run(self, manager, args, kwargs, callback):
+        '''
+        Executes operation with plain callbacks, without `gen.engine` and
+        stack context wrappers. `callback(result, error)` is called exactly
+        once, for both `MotorManager` and `FutureManager` operations.
+        '''
+        modifier = kwargs.pop('modifier', self.modifier)
+        as_model = kwargs.pop('as_model', self.as_model)
+        hard = kwargs.pop('hard', self.hard)
+        trusted = manager.trusted_read(kwargs.pop('trusted', None))
+        lazy = kwargs.pop('lazy', None)
+        # read-through cache can be skipped, e.g. to read fresh version
+        use_cache = kwargs.pop('cache', True)
+        # read-only views instead of models (see `RawDocument`)
+        raw = kwargs.pop('raw', manager.raw_reads) and as_model
+        # nothing is measured without hooks
+        measure = bool(metrics.hooks)
+
+        # unacknowledged writes are returned right after enqueue (see
+        # `WriteQueue`)
+        if kwargs.pop('fire_and_forget', manager.fire_and_forget) and \
+                self.action in WriteQueue.ACTIONS:
+            try:
+                queue = manager.get_write_queue(kwargs.pop('db', None))
+                kwargs.pop('read_preference', None)
+                # cached data is dropped right away, as for acknowledged
+                # writes, and again when batch is sent
+                manager.invalidate()
+                queue.put(self.action, args, kwargs, callback)
+            except Exception, e:
+                callback(None, e)
+            return
+
+        def finish(result, error, network_time=0.0, hydrate=as_model):
+            hydration_time = 0.0
+            if error is None and hydrate:
+                try:
+                    started = time.time() if measure else None
+                    if raw:
+                        result = manager.create_raw(result, tz_aware)
+                    else:
+                        result = self.hydrate(manager, result, args, kwargs,
+                                              hard, trusted, lazy, identity)
+                    if measure:
+                        hydration_time = time.time() - started
+                except Exception, e:
+                    result, error = None, e
+            if self.invalidate:
+                manager.invalidate()
+            if measure:
+                metrics.report(manager, self, args, network_time,
+                               hydration_time, result, error)
+            callback(result, error)
+
+        identity = key = None
+        tz_aware = False
+        try:
+            db = manager.get_db(kwargs.pop('db', None),
+                                kwargs.pop('read_preference', None))
+            dbc = db[manager.collection_name]
+            shared = True
+            if raw:
+                raw_dbc = raw_collection(dbc)
+                # documents read as bytes cannot be shared with models
+                shared = raw_dbc is dbc
+                dbc = raw_dbc
+                tz_aware = is_tz_aware(dbc)
+
+            # Partial documents are not registered in identity map, because
+            # they cannot be shared.
+            identity = current_identity_map() if as_model and not raw \
+                else None
+            if identity is not None and is_projected(args, kwargs):
+                identity = None
+            known = None
+            if identity is not None and self.action == 'find_one':
+                known = identity.get(manager.collection,
+                                     lookup_id(args, kwargs))
+
+            cached = None
+            if known is None:
+                if use_cache:
+                    key = self.cache_key(manager, db, modifier, args, kwargs)
+                if key is not None and not shared:
+                    key = 'raw:' + key
+                if key is not None:
+                    cached = manager.cache.get(key)
+                    # result read before write must not be cached after it
+                    generation = manager.cache_generation
+        except Exception, e:
+            finish(None, e)
+            return
+
+        if known is not None:
+            finish(known, None, hydrate=False)
+            return
+        if cached is not None:
+            # cached raw data must not be shared with models, but read-only
+            # views can share it
+            finish(cached if raw else copy.deepcopy(cached), None)
+            return
+
+        started = time.time() if measure else None
+
+        def on_result(result, error):
+            network_time = time.time() - started if measure else 0.0
+            if error is None and key is not None:
+                if result is not None and \
+                        generation == manager.cache_generation:
+                    manager.cache.set(key, result)
+                if not raw:
+                    result = copy.deepcopy(result)
+            finish(result, error, network_time)
+
+        self.query(dbc, modifier, *args, callback=on_result, **kwargs)
+
+    def hydrate(self, manager, result, args, kwargs, hard=False,
+                trusted=None, lazy=None, identity=None):
+        # Unfortunately we cannot use `as class` option for auto conversion
+        # to model class, because mongo uses same class for top-level and
+        # inner documents.
+        if isinstance(result, (list, tuple, set)):
+            result = manager.create(result, trusted=trusted, lazy=lazy)
+        else:
+            result = manager.create_one(result, hard=hard, trusted=trusted,
+                                        lazy=lazy)
+        projection = find_projection(args, kwargs)
+        if projection is not None:
+            _set_projection(result, projection)
+        if identity is not None:
+            result = identity.register(result)
+        return result
+
+    def execute(self, manager, *args, **kwargs):
+        assert 'callback' in kwargs
+        callback = kwargs.pop('callback')
+        self.run(manager, args, kwargs, callback)
+
     @classmethod
     def bind(cls, *args, **kwargs):
         operation = cls(*args, **kwargs)
 
         @gen.engine
-        def execute(manager, db, *argz, **kwargz):
+        def execute(manager, *argz, **kwargz):
             assert 'callback' in kwargz, '`callback` is required'
 
             callback = kwargz.pop('callback')
             kwargz['callback'] = stack_context.wrap(callback)
-            operation.execute(manager, db, *argz, **kwargz)
+            operation.execute(manager, *argz, **kwargz)
+        execute.operation = operation
+        return execute
+
+    @classmethod
+    def bind_future(cls, *args, **kwargs):
+        '''
+        Same as `bind`, but operation returns Future, unless `callback` is
+        given. Callback is called directly, e.g. from `motor.Op`.
+        '''
+        if len(args) == 1 and isinstance(args[0], cls):
+            operation = args[0]
+        else:
+            operation = cls(*args, **kwargs)
+
+        def execute(manager, *argz, **kwargz):
+            callback = kwargz.pop('callback', None)
+            if callback is not None:
+                operation.run(manager, argz, kwargz, callback)
+                return
+            future = TracebackFuture()
+            operation.run(manager, argz, kwargz,
+                          functools.partial(_resolve, future))
+            return future
+        execute.operation = operation
         return execute
 
 bind_op = MotorOp.bind
+bind_future_op = MotorOp.bind_future
+
+
+def _resolve(future, result, error):
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def _then(callback, handle):
+    '''
+    Returns callback of inner operation, which passes its result through
+    `handle(result)` to `callback`. Errors of both are passed to `callback`.
+    '''
+    def on_result(result, error):
+        if error is None:
+            try:
+                result = handle(result)
+            except Exception, e:
+                result, error = None, e
+        callback(result, error)
+    return on_result
+
+
+def return_future(method):
+    '''
+    Adapts callback-style method `method(..., callback)` to return Future,
+    if `callback` is omitted, e.g. `yield manager.save(document)` inside
+    `gen.coroutine`.
+    '''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if kwargs.get('callback') is not None:
+            return method(*args, **kwargs)
+        future = TracebackFuture()
+        kwargs['callback'] = functools.partial(_resolve, future)
+        method(*args, **kwargs)
+        return future
+    return wrapper
+
+
+# name of relevance score in projection of text search
+TEXT_SCORE = '_text_score'
+# error code of `$text` query without text index
+TEXT_INDEX_NOT_FOUND = 27
+# error codes of duplicate key on insert and on upsert
+DUPLICATE_KEY = (11000, 11001)
+
+
+def _set_projection(documents, projection):
+    if not isinstance(documents, list):
+        documents = [documents]
+    [x.set_projection(projection) for x in documents if x is not None]
+
+
+class MotorStream(object):
+    '''
+    Pull-based wrapper around motor cursor, which yields documents in
+    fixed-size batches. Next batch is not fetched until client code asks
+    for it, so slow consumer never makes whole result set to be buffered.
+    Usage:
+
+        stream = Model.objects.stream({'a': 1}, batch_size=500)
+        while True:
+            batch = yield motor.Op(stream.next_batch)
+            if not batch:
+                break
+            ...
+        stream.close()  # only needed if iteration was stopped early
+    '''
+
+    def __init__(self, manager, cursor, batch_size=100, as_model=True,
+                 trusted=None, lazy=None, projection=None, raw=False,
+                 tz_aware=False):
+        self.manager = manager
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.as_model = as_model
+        self.raw = raw
+        self.tz_aware = tz_aware
+        self.trusted = manager.trusted_read(trusted)
+        self.lazy = lazy
+        self.projection = projection
+        self.closed = False
+
+    @gen.engine
+    def next_batch(self, callback):
+        if self.closed:
+            callback([], None)
+            return
+        batch = []
+        try:
+            while len(batch) < self.batch_size and \
+                    (yield self.cursor.fetch_next):
+                batch.append(self.cursor.next_object())
+            if len(batch) < self.batch_size:
+                self.close()  # cursor is exhausted
+            if self.raw:
+                batch = self.manager.create_raw(batch, self.tz_aware)
+            elif self.as_model:
+                batch = self.manager.create(batch, trusted=self.trusted,
+                                            lazy=self.lazy)
+                if self.projection is not None:
+                    _set_projection(batch, self.projection)
+        except Exception, e:
+            self.close()
+            callback(None, e)
+            return
+        callback(batch, None)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.cursor.alive:
+                self.cursor.close()
 
 
 class BaseManager(object):
 
+    # Documents read from database are hydrated without validation, it can
+    # be disabled per manager or per call with `trusted=False`. Documents
+    # created by `create*` methods are validated unless `trusted=True`.
+    trusted_reads = True
+    # Documents are returned as read-only `RawDocument` views, which skip
+    # hydration, it can be enabled per call with `raw=True`.
+    raw_reads = False
+    # Untrusted batches of this size are validated column by column, smaller
+    # ones row by row (see `Collection.create_batch`).
+    batch_hydration_size = 100
+    # Writes are queued and sent in background without acknowledgement, it
+    # can be enabled per call with `fire_and_forget=True`.
+    fire_and_forget = False
+
     def __init__(self, collection=None):
         self.collection = collection
 
@@ -118,14 +424,51 @@ class BaseManager(object):
     def collection_name(self):
         return self.collection.collection_name()
 
-    def create_one(self, data, hard=False):
+    def trusted_read(self, trusted=None):
+        '''
+        Returns whether documents read from database are hydrated without
+        validation, `trusted` is option of the call.
+        '''
+        if trusted is None:
+            return self.trusted_reads
+        return trusted
+
+    def _creator(self, trusted=False, lazy=None):
+        if lazy is None:
+            lazy = self.collection.__lazy__
+        if lazy:
+            return functools.partial(self.collection.create_lazy,
+                                     trusted=trusted)
+        if trusted:
+            return self.collection.create_trusted
+        return self.collection.create
+
+    def create_one(self, data, hard=False, trusted=False, lazy=None):
         if data:
-            return self.collection.create(data)
+            return self._creator(trusted, lazy)(data)
         elif hard:
             return self.collection.create({})
 
-    def create(self, data):
-        return [self.collection.create(x) for x in data] if data else []
+    def create(self, data, trusted=False, lazy=None):
+        create = self._creator(trusted, lazy)
+        # invalid rows of untrusted batch are reported by one error type,
+        # whatever size of batch is
+        if data and create == self.collection.create:
+            documents, errors = self.collection.create_batch(
+                data, columnar=len(data) >= self.batch_hydration_size)
+            if errors:
+                raise BatchValidationError(errors)
+            return documents
+        return [create(x) for x in data] if data else []
+
+    def create_raw(self, data, tz_aware=False):
+        '''
+        Wraps documents to read-only views (see `RawDocument`), BSON bytes
+        are decoded with `tz_aware` option.
+        '''
+        if isinstance(data, (list, tuple, set)):
+            return [RawDocument.wrap(x, tz_aware) for x in data]
+        return RawDocument.wrap(data, tz_aware)
 
     def create_dicts(self, data, exclude_unset=False):
         return self.as_dicts(self.create(data), exclude_unset=exclude_unset)
@@ -133,31 +476,615 @@ class BaseManager(object):
     def as_dicts(self, data, exclude_unset=False):
         return [x.as_dict(exclude_unset=exclude_unset) for x in data]
 
+    def invalidate(self):
+        '''
+        Called after every write operation to drop cached data.
+        '''
+
 
 class MotorManager(BaseManager):
 
-    insert        = bind_op('insert')
-    save          = bind_op('save')
-    update        = bind_op('update')
-    remove        = bind_op('remove')
-    find          = bind_op('find', 'to_list', as_model=True)
-    find_one      = bind_op('find_one', as_model=True)
+    stream_batch_size = 100
+    stream_class = MotorStream
+    count_cache_ttl = 60
+    # options of `WriteQueue` for `fire_and_forget` writes
+    write_queue_options = {}
+
+    insert        = bind_op('insert', invalidate=True)
+    save_dict     = bind_op('save', invalidate=True)
+    update        = bind_op('update', invalidate=True)
+    remove        = bind_op('remove', invalidate=True)
+    find          = bind_op('find', 'to_list', as_model=True, cacheable=True)
+    find_one      = bind_op('find_one', as_model=True, cacheable=True)
     count         = bind_op('find', 'count')
     group         = bind_op('group')
     create_index  = bind_op('create_index')
     ensure_index  = bind_op('ensure_index')
     aggregate     = bind_op('aggregate')
-    find_and_modify = bind_op('find_and_modify')
+    find_and_modify = bind_op('find_and_modify', invalidate=True)
+
+    def __init__(self, collection=None, db_alias=None, read_preference=None):
+        super(MotorManager, self).__init__(collection=collection)
+        self.db_alias = db_alias
+        self.read_preference = read_preference
+        self.count_cache = TTLCache(ttl=self.count_cache_ttl)
+        self._cache = None
+        self._cache_ready = False
+        # incremented by every `invalidate`
+        self.cache_generation = 0
+        self._loaders = {}
+        self._write_queues = {}
+
+    def get_db(self, db=None, read_preference=None):
+        '''
+        Returns database for operation. `db` can be database object or
+        alias of registered one. By default alias and read preference are
+        taken from manager or collection class (`__db_alias__` and
+        `__read_preference__`).
+        '''
+        if db is not None and not isinstance(db, basestring):
+            return db
+        alias = db or self.db_alias or \
+            getattr(self.collection, '__db_alias__', None) or DEFAULT_ALIAS
+        if read_preference is None:
+            read_preference = self.read_preference
+        if read_preference is None:
+            read_preference = getattr(self.collection,
+                                      '__read_preference__', None)
+        return current_db(alias, read_preference)
+
+    @property
+    def cache(self):
+        '''
+        Read-through cache of `find` and `find_one` results, it's enabled
+        by `__cache__` options of collection class, e.g.:
+
+            __cache__ = {'max_size': 100, 'ttl': 300}
+        '''
+        # collection can be assigned after manager creation
+        if not self._cache_ready:
+            options = getattr(self.collection, '__cache__', None)
+            if options:
+                self._cache = LRUCache(**options)
+            self._cache_ready = True
+        return self._cache
+
+    def invalidate(self):
+        self.cache_generation += 1
+        self.count_cache.invalidate()
+        if self.cache is not None:
+            self.cache.invalidate()
+        identity = current_identity_map()
+        if identity is not None:
+            identity.discard(self.collection)
 
     @gen.engine
-    def all(self, *args, **kwargs):
-        self.find(*args, **kwargs)
+    def estimated_count(self, callback, db=None):
+        '''
+        Returns number of documents from collection stats, which is much
+        cheaper than counting, but it may be inaccurate.
+        '''
+        try:
+            db = self.get_db(db)
+            stats = yield motor.Op(db.command, 'collstats',
+                                   self.collection_name)
+            result = stats.get('count', 0)
+        except Exception, e:
+            callback(None, e)
+            return
+        callback(result, None)
+
+    def cached_count(self, spec=None, **kwargs):
+        '''
+        Same as `count`, but result is cached for `ttl` seconds or until
+        next write operation through this manager. With `estimate=True`
+        collection stats are used for empty spec.
+        '''
+        callback = kwargs.pop('callback')
+        ttl = kwargs.pop('ttl', None)
+        estimate = kwargs.pop('estimate', False)
+        try:
+            # counts of different databases must not share cache entry
+            db = self.get_db(kwargs.get('db'), kwargs.get('read_preference'))
+            key = query_key(getattr(db, 'name', None), spec, estimate)
+            result = self.count_cache.get(key)
+            generation = self.cache_generation
+        except Exception, e:
+            callback(None, e)
+            return
+        if result is not None:
+            callback(result, None)
+            return
+
+        def store(result):
+            # count made before write must not be cached after it
+            if generation == self.cache_generation:
+                self.count_cache.set(key, result, ttl)
+            return result
+        if estimate and not spec:
+            self.estimated_count(db=kwargs.get('db'),
+                                 callback=_then(callback, store))
+        else:
+            self.count(spec or {}, callback=_then(callback, store), **kwargs)
+
+    def stream(self, *args, **kwargs):
+        '''
+        Same as `find`, but returns `MotorStream` instead of list of models.
+        Accepts `batch_size`, `modifier`, `as_model`, `trusted`, `lazy`,
+        `raw`, `db` and `read_preference` options.
+        '''
+        batch_size = kwargs.pop('batch_size', self.stream_batch_size)
+        modifier = kwargs.pop('modifier', None)
+        as_model = kwargs.pop('as_model', True)
+        trusted = kwargs.pop('trusted', None)
+        lazy = kwargs.pop('lazy', None)
+        raw = kwargs.pop('raw', self.raw_reads) and as_model
+        db = self.get_db(kwargs.pop('db', None),
+                         kwargs.pop('read_preference', None))
+        dbc = db[self.collection_name]
+        if raw:
+            dbc = raw_collection(dbc)
+        cursor = dbc.find(*args, **kwargs)
+        if modifier:
+            cursor = modifier(cursor) or cursor
+        cursor = cursor.batch_size(batch_size)
+        return self.stream_class(self, cursor, batch_size, as_model=as_model,
+                                 trusted=trusted, lazy=lazy,
+                                 projection=find_projection(args, kwargs),
+                                 raw=raw, tz_aware=is_tz_aware(dbc))
+
+    def aggregation(self, *pipeline):
+        '''
+        Returns `Aggregation` builder, which streams results in batches
+        instead of single `aggregate` response document.
+        '''
+        return Aggregation(self, pipeline)
 
     @gen.engine
-    def one(self, *args, **kwargs):
+    def each_batch(self, *args, **kwargs):
+        '''
+        Calls `handler(batch)` for each batch of found documents. Handler can
+        return `False` to stop iteration. Result is total number of handled
+        documents.
+        '''
         callback = kwargs.pop('callback')
-        result = yield motor.Op(self.find, *args, **kwargs)
-        if result and len(result) > 1:
-            raise ValueError("Multiple results found.")
-        result = result[0] if result else None
+        handler = kwargs.pop('handler')
+        count = 0
+        stream = None
+        try:
+            stream = self.stream(*args, **kwargs)
+            while True:
+                batch = yield motor.Op(stream.next_batch)
+                if not batch:
+                    break
+                count += len(batch)
+                if handler(batch) is False:
+                    stream.close()
+                    break
+        except Exception, e:
+            if stream is not None:
+                stream.close()
+            callback(None, e)
+            return
+        callback(count, None)
+
+    def loader(self, key='_id', **kwargs):
+        '''
+        Returns `Loader`, which coalesces lookups by `key` into batches.
+        Loaders with default options are shared.
+        '''
+        if kwargs:
+            return Loader(self, key, **kwargs)
+        loader = self._loaders.get(key)
+        if loader is None:
+            loader = self._loaders[key] = Loader(self, key)
+        return loader
+
+    def load(self, value, callback, key='_id'):
+        '''
+        Same as `find_one({key: value})`, but lookups made within same IOLoop
+        iteration are sent as one query.
+        '''
+        self.loader(key).load(value, callback)
+
+    def bulk(self, ordered=True, **kwargs):
+        '''
+        Returns `BulkWriter` to send many write operations at once.
+        '''
+        return BulkWriter(self, ordered=ordered, **kwargs)
+
+    def write_behind(self, **kwargs):
+        '''
+        Returns `WriteBehind` buffer, which flushes writes in batches.
+        '''
+        return WriteBehind(self, **kwargs)
+
+    @property
+    def write_queue(self):
+        return self.get_write_queue()
+
+    def get_write_queue(self, db=None):
+        '''
+        Returns `WriteQueue` of unacknowledged writes to `db` (see `get_db`),
+        which is created on first `fire_and_forget` write to it with
+        `write_queue_options`. Writes spilled to other than default database
+        get database name as suffix of `spill_path`.
+        '''
+        db = self.get_db(db)
+        queue = self._write_queues.get(db)
+        if queue is None:
+            options = dict(self.write_queue_options)
+            if options.get('spill_path') and db is not self.get_db():
+                options['spill_path'] += '.' + db.name
+            queue = self._write_queues[db] = WriteQueue(self, db=db,
+                                                        **options)
+        return queue
+
+    def insert_many(self, documents, **kwargs):
+        '''
+        Inserts documents (dicts or models) using bulk write.
+        '''
+        writer = self.bulk(ordered=kwargs.pop('ordered', True),
+                           batch_size=kwargs.pop('batch_size', 1000))
+        for document in documents:
+            writer.insert(document)
+        writer.execute(**kwargs)
+
+    # Composite methods with one inner operation chain plain callbacks, so
+    # `FutureManager` versions add only one Future on top.
+
+    def save(self, to_save, **kwargs):
+        '''
+        Saves dict or model. Partial document (loaded with projection) is
+        saved with `$set` of loaded fields only, so fields which were not
+        loaded are never overwritten.
+        '''
+        callback = kwargs.pop('callback')
+        update = None
+        try:
+            if hasattr(to_save, 'as_dict'):
+                to_save = to_save.as_dict()
+            if getattr(to_save, 'partial', False):
+                if not to_save.get('_id'):
+                    raise ValueError(
+                        'Partial document w/o "_id" cannot be saved.')
+                update = to_save.as_update()
+        except Exception, e:
+            callback(None, e)
+            return
+        if update is not None:
+            _id = to_save['_id']
+            self.update({'_id': _id}, update,
+                        callback=_then(callback, lambda result: _id),
+                        **kwargs)
+        else:
+            self.save_dict(to_save, callback=callback, **kwargs)
+
+    def complete(self, document, **kwargs):
+        '''
+        Loads fields missing in partial document with one query.
+        '''
+        callback = kwargs.pop('callback')
+        trusted = self.trusted_read(kwargs.pop('trusted', None))
+        try:
+            missing = document.missing_fields() if document.partial else []
+        except Exception, e:
+            callback(None, e)
+            return
+        if not missing:
+            callback(document, None)
+            return
+
+        def fill(raw_data):
+            document.complete(raw_data or {}, trusted=trusted)
+            return document
+        self.find_one({'_id': document._id}, fields=missing, as_model=False,
+                      callback=_then(callback, fill), **kwargs)
+
+    def save_changes(self, document, **kwargs):
+        '''
+        Writes only fields changed since document was loaded using `$set`
+        and `$unset`. Only changed fields are validated. Result is `None` if
+        there is nothing to save.
+        '''
+        callback = kwargs.pop('callback')
+        try:
+            paths = document.dirty_fields()
+            if paths:
+                if not document.get('_id'):
+                    raise ValueError(
+                        'Document w/o "_id" cannot be updated partially.')
+                document.validate(fields=paths)
+                update = document.changes(paths)
+        except Exception, e:
+            callback(None, e)
+            return
+        if not paths:
+            callback(None, None)
+            return
+
+        def saved(result):
+            document.mark_clean()
+            return result
+        self.update({'_id': document._id}, update,
+                    callback=_then(callback, saved), **kwargs)
+
+    def save_versioned(self, document, **kwargs):
+        '''
+        Writes changed fields only if version of document in database is
+        the same as loaded one, and increments version (see
+        `Collection.__version_field__`). Raises `ConflictError` if document
+        was changed since it was loaded. Document without version is saved
+        with version 1: new one is inserted, and stored one (e.g. written
+        before versioning) is replaced only if it still has no version.
+        '''
+        callback = kwargs.pop('callback')
+        version_field = self.collection.__version_field__
+        try:
+            if version_field is None:
+                raise TypeError('Collection "%s" has no version field.' %
+                                (self.collection_name,))
+            version = getattr(document, version_field)
+            if not version:
+                setattr(document, version_field, 1)
+                document.validate()
+                to_insert = document.as_dict()
+                if to_insert.get('_id'):
+                    update = to_insert.as_update() \
+                        if getattr(to_insert, 'partial', False) \
+                        else {'$set': dict([(k, v) for k, v in
+                                            to_insert.iteritems()
+                                            if k != '_id'])}
+            else:
+                # version is changed by database only
+                paths = [x for x in document.dirty_fields()
+                         if x != version_field]
+                document.validate(fields=paths)
+                update = document.changes(paths)
+                update.setdefault('$inc', {})[version_field] = 1
+        except Exception, e:
+            callback(None, e)
+            return
+
+        def inserted(result):
+            document._id = result
+            document.mark_clean()
+            return result
+
+        def updated(result):
+            # unacknowledged write cannot detect conflicts
+            if not result or not result.get('n'):
+                raise ConflictError('Document %s of version %s was changed.' %
+                                    (document._id, version))
+            if version:
+                setattr(document, version_field, version + 1)
+            document.mark_clean()
+            return result
+
+        def upserted(result, error):
+            # document was versioned by someone else since it was read
+            if getattr(error, 'code', None) in DUPLICATE_KEY:
+                result, error = None, ConflictError(
+                    'Document %s without version was changed.' %
+                    (document._id,))
+            _then(callback, updated)(result, error)
+        if not version and to_insert.get('_id'):
+            # `None` matches missing field too
+            self.update({'_id': document._id,
+                         version_field: {'$in': [None, 0]}},
+                        update, upsert=True, callback=upserted, **kwargs)
+        elif not version:
+            self.insert(to_insert, callback=_then(callback, inserted),
+                        **kwargs)
+        else:
+            self.update({'_id': document._id, version_field: version},
+                        update, callback=_then(callback, updated), **kwargs)
+
+    @gen.engine
+    def modify(self, spec, mutation, **kwargs):
+        '''
+        Reads document, applies `mutation(document)` and saves it with
+        `save_versioned`. On conflict document is read again and mutation
+        is re-applied after backoff delay (see `utils.optimistic_async`, which
+        gets `repeats`, `backoff`, `max_backoff` and `stats` options).
+        Result is saved document, or `None` if it's not found or mutation
+        returned `False`.
+        '''
+        callback = kwargs.pop('callback')
+        options = dict([(name, kwargs.pop(name)) for name in
+                        ('repeats', 'backoff', 'max_backoff', 'stats')
+                        if name in kwargs])
+
+        @gen.engine
+        def attempt(callback):
+            try:
+                document = yield motor.Op(self.find_one, spec, cache=False,
+                                          **kwargs)
+                if document is not None and mutation(document) is not False:
+                    yield motor.Op(self.save_versioned, document)
+                else:
+                    document = None
+            except Exception, e:
+                callback(None, e)
+                return
+            callback(document, None)
+
+        try:
+            result = yield motor.Op(optimistic_async, attempt,
+                                    retry_on_error=False, **options)
+        except Exception, e:
+            callback(None, e)
+            return
         callback(result, None)
+
+    @gen.engine
+    def search(self, text, spec=None, fields=None, **kwargs):
+        '''
+        Finds documents by text index, most relevant first. Result is list
+        of (document, score) pairs. If collection has no text index and
+        `fallback` fields are given, they are matched with `match_exact`
+        regex and scores are `None`. Usage:
+
+            yield motor.Op(Place.objects.create_index, [('name', 'text'),
+                                                        ('about', 'text')])
+            results = yield motor.Op(Place.objects.search, 'coffee shop',
+                                     {'city': city}, fields='name,city',
+                                     limit=20)
+        '''
+        callback = kwargs.pop('callback')
+        limit = kwargs.pop('limit', 0)
+        language = kwargs.pop('language', None)
+        fallback = kwargs.pop('fallback', None)
+        trusted = self.trusted_read(kwargs.pop('trusted', None))
+        lazy = kwargs.pop('lazy', None)
+        projection = None
+        try:
+            if fields is not None:
+                projection = fields if isinstance(fields, dict) \
+                    else model_fields(fields)
+            spec = dict(spec or {}, **text_query(text, language))
+            meta = dict(projection or {})
+            meta[TEXT_SCORE] = {'$meta': 'textScore'}
+
+            def by_score(cursor):
+                cursor = cursor.sort([(TEXT_SCORE, {'$meta': 'textScore'})])
+                return cursor.limit(limit) if limit else cursor
+            try:
+                documents = yield motor.Op(self.find, spec, meta,
+                                           modifier=by_score, as_model=False,
+                                           **kwargs)
+                scores = [x.pop(TEXT_SCORE, None) for x in documents]
+            except Exception, e:
+                if not fallback or not _no_text_index(e):
+                    raise
+                spec.pop('$text')
+                documents = yield motor.Op(
+                    self.find, _match_any(spec, fallback, text), projection,
+                    modifier=lambda cursor: cursor.limit(limit),
+                    as_model=False, **kwargs)
+                scores = [None] * len(documents)
+            documents = self.create(documents, trusted=trusted, lazy=lazy)
+            if projection is not None:
+                _set_projection(documents, projection)
+        except Exception, e:
+            callback(None, e)
+            return
+        callback(zip(documents, scores), None)
+
+    @gen.engine
+    def autocomplete(self, prefix, field, spec=None, **kwargs):
+        '''
+        Finds documents, which normalized `field` (`NormalizedField` or its
+        source field) starts with `prefix`, in order of `field`. Query uses
+        index on normalized field. Usage:
+
+            places = yield motor.Op(Place.objects.autocomplete, u'Caf',
+                                    'name', limit=10)
+        '''
+        callback = kwargs.pop('callback')
+        limit = kwargs.pop('limit', 10)
+        try:
+            shadows = self.collection.__shadow_fields__.get(field)
+            if shadows:
+                field = shadows[0]
+            if field not in self.collection.__fields__:
+                raise KeyError('Collection "%s" has no field "%s".' %
+                               (self.collection_name, field))
+            condition = match_prefix(prefix)
+            if condition is None:
+                result = []
+            else:
+                # stored documents are keyed by attribute names (see
+                # `as_dict`)
+                spec = dict(spec or {})
+                spec[field] = condition
+                result = yield motor.Op(
+                    self.find, spec,
+                    modifier=lambda cursor: cursor.sort(
+                        field, 1).limit(limit),
+                    **kwargs)
+        except Exception, e:
+            callback(None, e)
+            return
+        callback(result, None)
+
+    def all(self, *args, **kwargs):
+        self.find(*args, **kwargs)
+
+    def one(self, *args, **kwargs):
+        def single(result):
+            if result and len(result) > 1:
+                raise ValueError("Multiple results found.")
+            return result[0] if result else None
+        kwargs['callback'] = _then(kwargs['callback'], single)
+        self.find(*args, **kwargs)
+
+
+def _no_text_index(error):
+    return getattr(error, 'code', None) == TEXT_INDEX_NOT_FOUND or \
+        'text index required' in str(error)
+
+
+def _match_any(spec, fields, text):
+    '''
+    Returns `spec` with unanchored regex of `text` words for any of
+    `fields` (see `match_exact`).
+    '''
+    condition = match_exact(text)
+    if condition is None:
+        return dict(spec, _id={'$in': []})  # nothing can be found
+    spec = dict(spec)
+    spec['$and'] = list(spec.get('$and', [])) + [
+        {'$or': [{x: condition} for x in fields]}]
+    return spec
+
+
+class FutureStream(MotorStream):
+    '''
+    `MotorStream`, which `next_batch` returns Future.
+    '''
+    next_batch = return_future(MotorStream.next_batch.im_func)
+
+
+class FutureManager(MotorManager):
+    '''
+    Manager with the same operations as `MotorManager`, but they return
+    Futures, when `callback` is omitted, e.g.:
+
+        class User(Collection):
+            __manager__ = FutureManager
+
+        @gen.coroutine
+        def get(self, user_id):
+            user = yield User.objects.find_one({'_id': user_id})
+
+    Operations skip `gen.engine`, stack context and `motor.Op` layers of
+    `bind_op`. Callback is still accepted, so existing code like
+    `yield motor.Op(User.objects.find, spec)` keeps working.
+
+    Note that Tornado 3.x resolves yielded Future on next IOLoop iteration
+    (see `IOLoop.add_future`), so yielding Future isn't faster than
+    `motor.Op` of `MotorManager`, and `motor.Op` with callback is the
+    cheapest way to call operations of both managers.
+    '''
+
+    stream_class = FutureStream
+
+    def estimated_count(self, callback=None, db=None):
+        return _estimated_count(self, callback=callback, db=db)
+
+    def load(self, value, callback=None, key='_id'):
+        return _load(self, value, callback=callback, key=key)
+
+
+_estimated_count = return_future(MotorManager.estimated_count.im_func)
+_load = return_future(MotorManager.load.im_func)
+
+for _name, _method in MotorManager.__dict__.items():
+    if hasattr(_method, 'operation'):
+        setattr(FutureManager, _name, bind_future_op(_method.operation))
+for _name in ('cached_count', 'each_batch', 'insert_many', 'save',
+              'complete', 'save_changes', 'save_versioned', 'modify',
+              'search', 'autocomplete', 'all', 'one'):
+    setattr(FutureManager, _name,
+            return_future(getattr(MotorManager, _name).im_func))
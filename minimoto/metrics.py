@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+
+
+__all__ = ['OperationStats', 'register_hook', 'unregister_hook',
+           'query_shape', 'Histogram', 'SlowQueryLogger', ]
+
+
+# Hooks called with `OperationStats` after every manager operation. Nothing
+# is measured while list is empty.
+hooks = []
+
+
+def register_hook(hook):
+    if hook not in hooks:
+        hooks.append(hook)
+    return hook
+
+
+def unregister_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+def query_shape(spec):
+    '''
+    Returns spec with values replaced by `1`, so queries that differ by
+    values only have same shape.
+    Usage:
+    >>> query_shape({'a': 5, 'b': {'$in': [1, 2]}})
+    {'a': 1, 'b': {'$in': 1}}
+    '''
+    if isinstance(spec, dict):
+        return dict([(k, query_shape(v)) for k, v in spec.iteritems()])
+    if isinstance(spec, (list, tuple)) and spec and \
+            isinstance(spec[0], dict):
+        return [query_shape(x) for x in spec]
+    return 1
+
+
+class OperationStats(object):
+
+    def __init__(self, collection, action, qualifier, args, network_time,
+                 hydration_time, count, error):
+        self.collection = collection
+        self.action = action
+        self.qualifier = qualifier
+        self.args = args
+        self.network_time = network_time
+        self.hydration_time = hydration_time
+        self.count = count
+        self.error = error
+
+    @property
+    def latency(self):
+        return self.network_time + self.hydration_time
+
+    @property
+    def shape(self):
+        if not self.args:
+            return None
+        spec = self.args[0]
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}  # find_one by id
+        return query_shape(spec)
+
+    def __str__(self):
+        return '<%s.%s%s: %.1fms (network %.1fms), %s docs%s>' % (
+            self.collection, self.action,
+            '.%s' % self.qualifier if self.qualifier else '',
+            self.latency * 1000, self.network_time * 1000, self.count,
+            ', error: %s' % (self.error,) if self.error else '')
+
+
+def report(manager, operation, args, network_time, hydration_time, result,
+           error=None):
+    if isinstance(result, list):
+        count = len(result)
+    else:
+        count = 1 if result is not None else 0
+    stats = OperationStats(manager.collection_name, operation.action,
+                           operation.qualifier, args, network_time,
+                           hydration_time, count, error)
+    for hook in list(hooks):
+        try:
+            hook(stats)
+        except Exception:
+            logging.error('Exception in metrics hook', exc_info=True)
+
+
+class Histogram(object):
+    '''
+    In-process aggregator of operations latency by collection and action.
+    Bounds of latency buckets are given in seconds.
+    '''
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = list(bounds)
+        self.reset()
+
+    def reset(self):
+        self._data = {}
+
+    def __call__(self, stats):
+        key = (stats.collection, stats.action)
+        data = self._data.get(key)
+        if data is None:
+            data = self._data[key] = {
+                'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                'network': 0.0, 'hydration': 0.0, 'documents': 0,
+                'buckets': [0] * (len(self.bounds) + 1),
+            }
+        latency = stats.latency
+        data['count'] += 1
+        data['errors'] += 1 if stats.error else 0
+        data['total'] += latency
+        data['network'] += stats.network_time
+        data['hydration'] += stats.hydration_time
+        data['documents'] += stats.count
+        data['max'] = max(data['max'], latency)
+        data['buckets'][bisect.bisect_left(self.bounds, latency)] += 1
+
+    def percentile(self, key, percent):
+        '''
+        Returns upper bound of bucket, which contains given percentile (but
+        not greater than max latency).
+        '''
+        data = self._data.get(key)
+        if not data:
+            return None
+        rank = data['count'] * percent / 100.0
+        seen = 0
+        for index, count in enumerate(data['buckets']):
+            seen += count
+            if seen >= rank:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], data['max'])
+                break
+        return data['max']
+
+    def stats(self):
+        result = {}
+        for key, data in self._data.iteritems():
+            result[key] = dict(data, **{
+                'mean': data['total'] / data['count'],
+                'p50': self.percentile(key, 50),
+                'p99': self.percentile(key, 99),
+            })
+        return result
+
+
+class SlowQueryLogger(object):
+    '''
+    Logs operations, which take longer than `threshold` seconds.
+    '''
+
+    def __init__(self, threshold=0.1, logger=None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('minimoto.slow')
+
+    def __call__(self, stats):
+        if stats.latency >= self.threshold:
+            self.logger.warning('Slow query %s, shape: %s', stats,
+                                stats.shape)
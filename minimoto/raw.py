@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Read-only views of documents for endpoints, which only forward documents to
+clients, so neither models hydration nor `as_dict` is needed. Usage:
+
+    documents = yield motor.Op(Model.objects.find, spec, raw=True)
+    self.write(documents[0].raw)  # BSON bytes
+
+Documents are read as BSON bytes only if driver provides `RawBSONDocument`
+(pymongo 3.2+). Pinned motor 0.1 runs on pymongo 2.x, which always decodes
+documents, so there views skip hydration only and `raw` is encoded again
+on request.
+'''
+
+import collections
+
+from bson import BSON
+
+try:
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+except ImportError:  # driver decodes documents anyway
+    RawBSONDocument = CodecOptions = None
+
+
+def raw_collection(dbc):
+    '''
+    Returns collection, which reads documents as BSON bytes, if driver
+    supports it, otherwise `dbc` itself.
+    '''
+    if RawBSONDocument is None or not hasattr(dbc, 'with_options'):
+        return dbc
+    return dbc.with_options(codec_options=dbc.codec_options._replace(
+        document_class=RawBSONDocument))
+
+
+def is_tz_aware(dbc):
+    '''
+    Returns whether client of collection reads dates with timezone, so raw
+    documents are decoded the same way.
+    '''
+    return getattr(getattr(dbc, 'codec_options', None), 'tz_aware', False)
+
+
+_SLOTS = frozenset(['_raw', '_data', '_tz_aware'])
+
+
+class RawDocument(collections.Mapping):
+    '''
+    Read-only view of document. It keeps either BSON bytes, which are
+    decoded on first access and stay available as `raw`, or document
+    decoded by driver, which is encoded only if `raw` is requested.
+    Fields can be read as items or attributes. Nested values are shared
+    with view, so they must not be changed.
+    '''
+
+    def __init__(self, raw=None, data=None, tz_aware=False):
+        assert raw is not None or data is not None
+        self._raw = raw
+        self._data = data
+        self._tz_aware = tz_aware
+
+    @classmethod
+    def wrap(cls, document, tz_aware=False):
+        if document is None or isinstance(document, cls):
+            return document
+        raw = getattr(document, 'raw', None)  # `RawBSONDocument`
+        if isinstance(raw, bytes):
+            return cls(raw=raw, tz_aware=tz_aware)
+        return cls(data=document)
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = BSON.encode(self._data)
+        return self._raw
+
+    @property
+    def data(self):
+        if self._data is None:
+            if CodecOptions is None:
+                self._data = BSON(self._raw).decode(tz_aware=self._tz_aware)
+            else:
+                self._data = BSON(self._raw).decode(
+                    codec_options=CodecOptions(tz_aware=self._tz_aware))
+        return self._data
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __getattr__(self, name):
+        # own slots aren't set yet, e.g. while unpickling
+        if name in _SLOTS or name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self.data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def as_dict(self, exclude_unset=False):
+        return dict(self.data)
+
+    def __repr__(self):
+        state = 'raw' if self._data is None else self._data
+        return '<RawDocument: %s>' % (state,)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+In-memory stand-in for motor client used by tests, e.g.:
+
+    connector.connect('test', alias='test', connection_class=FakeClient)
+
+Supports only the part of motor API used by managers, and only equality,
+`$in`, `$exists` and `$regex` conditions in specs. Callbacks are always called on
+the next IOLoop iteration, like motor does.
+'''
+
+import re
+import functools
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from tornado.ioloop import IOLoop
+
+
+def _respond(callback, result, error=None):
+    if callback is not None:
+        IOLoop.instance().add_callback(
+            functools.partial(callback, result, error))
+
+
+def _match(document, spec):
+    if spec is None:
+        return True
+    if not isinstance(spec, dict):
+        spec = {'_id': spec}
+    for key, condition in spec.iteritems():
+        value = document.get(key)
+        if isinstance(condition, dict) and '$in' in condition:
+            if value not in condition['$in']:
+                return False
+        elif isinstance(condition, dict) and '$exists' in condition:
+            if (key in document) != bool(condition['$exists']):
+                return False
+        elif isinstance(condition, dict) and '$regex' in condition:
+            if not isinstance(value, basestring) or \
+                    not re.match(condition['$regex'], value):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor(object):
+
+    def __init__(self, collection, spec=None):
+        self.collection = collection
+        self.spec = spec
+
+    def _results(self):
+        return [dict(x) for x in self.collection.documents.values()
+                if _match(x, self.spec)]
+
+    def skip(self, skip):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def to_list(self, length=None, callback=None):
+        _respond(callback, self._results())
+
+    def count(self, callback=None):
+        _respond(callback, len(self._results()))
+
+
+class FakeCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.documents = {}
+
+    def find(self, spec=None, fields=None, **kwargs):
+        return FakeCursor(self, spec)
+
+    def find_one(self, spec_or_id=None, fields=None, callback=None, **kwargs):
+        result = None
+        for document in self.documents.itervalues():
+            if _match(document, spec_or_id):
+                result = dict(document)
+                break
+        _respond(callback, result)
+
+    def insert(self, doc_or_docs, callback=None, **kwargs):
+        documents = doc_or_docs
+        if not isinstance(documents, list):
+            documents = [documents]
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+            if document['_id'] in self.documents:
+                _respond(callback, None, DuplicateKeyError(
+                    'E11000 duplicate key', 11000))
+                return
+            self.documents[document['_id']] = dict(document)
+        ids = [x['_id'] for x in documents]
+        _respond(callback, ids if isinstance(doc_or_docs, list)
+                     else ids[0])
+
+    def save(self, to_save, callback=None, **kwargs):
+        to_save.setdefault('_id', ObjectId())
+        self.documents[to_save['_id']] = dict(to_save)
+        _respond(callback, to_save['_id'])
+
+    def update(self, spec, document, upsert=False, multi=False,
+               callback=None, **kwargs):
+        try:
+            n = self._update(spec, document, upsert, multi)
+        except DuplicateKeyError, e:
+            _respond(callback, None, e)
+            return
+        _respond(callback, {'ok': 1, 'n': n})
+
+    def _update(self, spec, document, upsert=False, multi=False):
+        n = 0
+        for _id, current in self.documents.items():
+            if not _match(current, spec):
+                continue
+            self._apply(_id, current, document)
+            n += 1
+            if not multi:
+                break
+        if not n and upsert:
+            _id = spec.get('_id', ObjectId())
+            if _id in self.documents:
+                raise DuplicateKeyError('E11000 duplicate key', 11000)
+            self.documents[_id] = {'_id': _id}
+            self._apply(_id, self.documents[_id], document)
+            n = 1
+        return n
+
+    def _apply(self, _id, current, document):
+        if not any(x.startswith('$') for x in document):
+            self.documents[_id] = dict(document, _id=_id)
+            return
+        current.update(document.get('$set', {}))
+        for key in document.get('$unset', {}):
+            current.pop(key, None)
+        for key, value in document.get('$inc', {}).iteritems():
+            current[key] = current.get(key, 0) + value
+
+    def remove(self, spec_or_id=None, callback=None, **kwargs):
+        removed = [k for k, v in self.documents.iteritems()
+                   if _match(v, spec_or_id)]
+        for _id in removed:
+            del self.documents[_id]
+        _respond(callback, {'ok': 1, 'n': len(removed)})
+
+
+class FakeDatabase(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.read_preference = None
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+    def command(self, command, *args, **kwargs):
+        callback = kwargs.pop('callback', None)
+        name = command.keys()[0] if isinstance(command, dict) else command
+        result = {'ok': 1}
+        if name == 'insert':
+            collection = self[command[name]]
+            for document in command['documents']:
+                collection.documents[document['_id']] = dict(document)
+            result['n'] = len(command['documents'])
+        elif name == 'update':
+            collection = self[command[name]]
+            result['n'] = sum(
+                collection._update(x['q'], x['u'], x.get('upsert'),
+                                   x.get('multi'))
+                for x in command['updates'])
+        _respond(callback, result)
+
+
+class FakeClient(object):
+
+    def __init__(self, **kwargs):
+        self._databases = {}
+
+    def __getitem__(self, name):
+        if name not in self._databases:
+            self._databases[name] = FakeDatabase(name)
+        return self._databases[name]
+
+    def disconnect(self):
+        self._databases = {}
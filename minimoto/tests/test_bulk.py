@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+import contextlib
+
+import motor
+
+from bson import BSON, ObjectId
+from tornado import gen
+from tornado import stack_context
+from tornado.ioloop import IOLoop
+
+import connector
+from fakedb import FakeClient
+from collection import Collection
+from field import StringField, ObjectIdField
+from bulk import WriteQueue, flush_queues
+
+
+class Item(Collection):
+    __db_alias__ = 'test_bulk'
+
+    _id = ObjectIdField()
+    name = StringField()
+    about = StringField()
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        connector.connect('test', alias='test_bulk',
+                          connection_class=FakeClient)
+        self.dbc = Item.objects.get_db()[Item.collection_name()]
+
+    def tearDown(self):
+        connector.disconnect('test_bulk')
+
+    def run_sync(self, func):
+        return IOLoop.instance().run_sync(gen.coroutine(func))
+
+
+class BulkWriterTest(BulkTestCase):
+
+    def test_insert_assigns_id(self):
+        item = Item.create({'name': u'a'})
+
+        def insert():
+            yield motor.Op(Item.objects.insert_many, [item])
+            yield motor.Op(Item.objects.save, item)
+        self.run_sync(insert)
+        self.assertIsNotNone(item._id)
+        self.assertEqual(self.dbc.documents.keys(), [item._id])
+
+    def test_save_assigns_id(self):
+        item = Item.create({'name': u'a'})
+        writer = Item.objects.bulk().save(item)
+        self.assertIsNotNone(item._id)
+        self.assertEqual(writer.operations[0][2]['_id'], item._id)
+
+    def test_save_partial(self):
+        _id = ObjectId()
+        self.dbc.documents[_id] = {'_id': _id, 'name': u'a', 'about': u'b'}
+        item = Item.create_trusted({'_id': _id, 'name': u'a'})
+        item.set_projection(['name'])
+        item.name = u'c'
+
+        def save():
+            yield motor.Op(Item.objects.bulk().save(item).execute)
+        self.run_sync(save)
+        self.assertEqual(self.dbc.documents[_id],
+                         {'_id': _id, 'name': u'c', 'about': u'b'})
+
+    def test_groups_by_size(self):
+        writer = Item.objects.bulk(batch_size=4)
+        writer.max_batch_bytes = 3000
+        for _ in range(10):
+            writer.insert({'name': u'x' * 1000})
+        writer.remove({'name': u'y'})
+        self.assertEqual([(kind, len(group)) for kind, _, group
+                          in writer._groups(writer.operations)],
+                         [('insert', 2)] * 5 + [('remove', 1)])
+
+
+class WriteBehindTest(BulkTestCase):
+
+    def test_callback_context(self):
+        current, seen = [], {}
+
+        @contextlib.contextmanager
+        def context(name):
+            current.append(name)
+            try:
+                yield
+            finally:
+                current.pop()
+
+        def write(name):
+            with stack_context.StackContext(lambda: context(name)):
+                buffered.insert({'name': name}, callback=lambda r, e:
+                                seen.setdefault(name, list(current)))
+
+        def check():
+            IOLoop.instance().add_callback(write, 'a')
+            IOLoop.instance().add_callback(write, 'b')
+            yield gen.Task(IOLoop.instance().add_timeout,
+                           IOLoop.instance().time() + 0.05)
+        buffered = Item.objects.write_behind(max_delay=0.01)
+        self.run_sync(check)
+        self.assertEqual(seen, {'a': ['a'], 'b': ['b']})
+
+
+class WriteQueueTest(BulkTestCase):
+
+    def setUp(self):
+        super(WriteQueueTest, self).setUp()
+        connector.connect('other', alias='test_bulk_other',
+                          connection_alias='test_bulk')
+
+    def test_db(self):
+        def write():
+            yield motor.Op(Item.objects.insert, {'name': u'a'},
+                           db='test_bulk_other', fire_and_forget=True)
+            yield motor.Op(Item.objects.insert, {'name': u'b'},
+                           fire_and_forget=True)
+            yield motor.Op(flush_queues)
+        self.run_sync(write)
+        other = connector.current_db('test_bulk_other')
+        self.assertEqual([x['name'] for x in self.dbc.documents.values()],
+                         [u'b'])
+        self.assertEqual([x['name'] for x in other[Item.collection_name()]
+                          .documents.values()], [u'a'])
+
+
+class SpillTest(BulkTestCase):
+
+    def setUp(self):
+        super(SpillTest, self).setUp()
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        super(SpillTest, self).tearDown()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def queue(self):
+        return WriteQueue(Item.objects, max_size=1, overflow='spill',
+                          spill_path=self.path)
+
+    def test_recover_partial_record(self):
+        queue = self.queue()
+        queue._spill(('insert', None, {'_id': 1}, False, False))
+        queue._spill(('insert', None, {'_id': 2}, False, False))
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as f:
+            f.write(BSON.encode({'_id': 3})[:7])
+        queue = self.queue()
+        self.assertEqual(os.path.getsize(self.path), size)
+        queue._spill(('insert', None, {'_id': 4}, False, False))
+
+        def drain():
+            yield motor.Op(queue.flush)
+        self.run_sync(drain)
+        self.assertEqual(sorted(self.dbc.documents), [1, 2, 4])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_drain_error(self):
+        queue = self.queue()
+        queue.put('insert', ({'_id': 1},))
+        queue.put('insert', ({'_id': 2},))
+        with open(self.path, 'wb') as f:
+            f.write('corrupt')
+        errors = []
+        queue.flush(lambda stats, error: errors.append(error))
+
+        def drain():
+            yield gen.Task(IOLoop.instance().add_timeout,
+                           IOLoop.instance().time() + 0.01)
+        self.run_sync(drain)
+        self.assertEqual(len(errors), 1)
+        self.assertIsNotNone(errors[0])
+        self.assertFalse(queue._draining)
+        self.assertEqual(self.dbc.documents.keys(), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
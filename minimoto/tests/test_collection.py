@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Run from `minimoto` directory:
+
+    python -m unittest discover tests
+'''
+
+import unittest
+
+import motor
+
+from datetime import datetime
+from bson import ObjectId
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import connector
+from fakedb import FakeClient
+from collection import Collection
+from field import Field, StringField, IntegerField, ListField, DictField, \
+    DateTimeField, EmbeddedDocumentField, ObjectIdField, NormalizedField, \
+    BatchValidationError
+
+
+class Address(Collection):
+    city = StringField()
+    zip_code = StringField(name='zip')
+
+
+class Tag(Collection):
+    title = StringField(required=True)
+    weight = IntegerField(default=1)
+
+
+class Person(Collection):
+    _id = ObjectIdField()
+    name = StringField(required=True)
+    age = IntegerField(default=18)
+    nick = StringField(name='n')
+    tags = ListField(Tag)
+    labels = ListField(unicode)
+    extra = DictField(default=dict)
+    address = EmbeddedDocumentField(Address)
+    created = DateTimeField()
+
+
+class Choice(Collection):
+    title = Field(choices=(u'a', u'b'))
+
+
+DOCUMENTS = [
+    {'name': u'Vasia'},
+    {'_id': ObjectId(), 'name': u'Vasia', 'age': 33, 'nick': u'vp',
+     'labels': [u'a', u'b'], 'extra': {'x': 1},
+     'created': datetime(2013, 5, 1, 12, 30)},
+    {'name': u'Petia', 'tags': [{'title': u'one'},
+                                {'title': u'two', 'weight': 5}],
+     'address': {'city': u'Kyiv', 'zip_code': u'01001'}},
+    {'name': u'Kolia', 'nick': None, 'address': {'city': u'Lviv'},
+     'tags': []},
+]
+
+
+class CompiledPathTest(unittest.TestCase):
+    '''
+    Compiled loader and dumper must give the same results as generic
+    `Collection.__init__` and `_as_dict`.
+    '''
+
+    def assert_same(self, compiled, generic):
+        self.assertEqual(sorted(compiled._data), sorted(generic._data))
+        for exclude_unset in (False, True):
+            self.assertEqual(compiled.as_dict(exclude_unset),
+                             generic._as_dict(exclude_unset))
+            self.assertEqual(generic.as_dict(exclude_unset),
+                             generic._as_dict(exclude_unset))
+
+    def test_compiled(self):
+        self.assertIsNotNone(Person.__compiled_loader__)
+        self.assertIsNotNone(Person.__compiled_dumper__)
+
+    def test_create(self):
+        for raw_data in DOCUMENTS:
+            self.assert_same(Person.create(raw_data),
+                             Person._create(raw_data))
+
+    def test_create_trusted(self):
+        for raw_data in DOCUMENTS:
+            dumped = Person._create(raw_data)._as_dict()
+            self.assert_same(Person.create_trusted(dumped),
+                             Person._create(dumped))
+
+    def test_defaults(self):
+        compiled = Person.create({'name': u'Vasia'})
+        generic = Person._create({'name': u'Vasia'})
+        self.assertEqual(compiled.age, generic.age)
+        self.assertEqual(compiled.extra, generic.extra)
+        self.assert_same(compiled, generic)
+        self.assertNotIn('age', compiled.as_dict(exclude_unset=True))
+
+    def test_renamed_fields(self):
+        raw_data = DOCUMENTS[2]
+        compiled = Person.create(raw_data)
+        self.assert_same(compiled, Person._create(raw_data))
+        self.assertEqual(compiled.address._data['zip'], u'01001')
+        self.assertEqual(compiled.as_dict()['address']['zip_code'],
+                         u'01001')
+
+    def test_nested(self):
+        compiled = Person.create(DOCUMENTS[2])
+        self.assertIsInstance(compiled.tags[0], Tag)
+        self.assertIsInstance(compiled.address, Address)
+        self.assertEqual(compiled.as_dict()['tags'],
+                         [{'title': u'one', 'weight': 1},
+                          {'title': u'two', 'weight': 5}])
+
+    def test_invalid(self):
+        for raw_data in ({'name': 5}, {'name': u'x', 'age': 'old'},
+                         {'name': u'x', 'unknown': 1}):
+            self.assertRaises(Exception, Person._create, raw_data)
+            self.assertRaises(Exception, Person.create, raw_data)
+
+
+class CreateBatchTest(unittest.TestCase):
+
+    def test_error_type(self):
+        manager = Person.objects
+        for size in (1, manager.batch_hydration_size):
+            for invalid in ({'name': 5}, {'name': u'x', 'unknown': 1},
+                            {'name': u'x', 'age': 'old'}):
+                rows = [{'name': u'x'}] * (size - 1) + [invalid]
+                with self.assertRaises(BatchValidationError) as context:
+                    manager.create(rows)
+                self.assertEqual(context.exception.errors.keys(), [size - 1])
+
+    def test_unhashable_choice(self):
+        rows = [{'title': u'a'}, {'title': [u'b']}]
+        for columnar in (False, True):
+            documents, errors = Choice.create_batch(rows, columnar=columnar)
+            self.assertEqual(documents[0].title, u'a')
+            self.assertEqual(errors.keys(), [1])
+
+
+class DirtyFieldsTest(unittest.TestCase):
+
+    def test_defaults_are_not_changes(self):
+        document = Person.create_trusted({'_id': ObjectId(), 'name': u'x'})
+        document.extra
+        document.as_dict()
+        self.assertEqual(document.dirty_fields(), [])
+        document.name = u'y'
+        self.assertEqual(document.dirty_fields(), ['name'])
+
+
+class Place(Collection):
+    __db_alias__ = 'test_collection'
+
+    _id = ObjectIdField()
+    name = StringField()
+    key = NormalizedField('name')
+    about = StringField()
+
+
+class NormalizedFieldTest(unittest.TestCase):
+
+    def setUp(self):
+        connector.connect('test', alias='test_collection',
+                          connection_class=FakeClient)
+        self.dbc = Place.objects.get_db()[Place.collection_name()]
+
+    def tearDown(self):
+        connector.disconnect('test_collection')
+
+    def partial_place(self):
+        _id = ObjectId()
+        place = Place.create_trusted({'_id': _id, 'name': u'Old Name'})
+        place.set_projection(['name'])
+        return place
+
+    def test_value(self):
+        place = Place.create({'name': u' Caf\xe9  Central'})
+        self.assertEqual(place.key, u'cafe central')
+        self.assertEqual(place.as_dict(exclude_unset=True)['key'],
+                         u'cafe central')
+
+    def test_changed_with_source(self):
+        place = Place.create_trusted({'_id': ObjectId(), 'name': u'A'})
+        place.name = u'New Name'
+        self.assertEqual(sorted(place.dirty_fields()), ['key', 'name'])
+        self.assertEqual(place.changes()['$set']['key'], u'new name')
+
+    def test_partial_update(self):
+        place = self.partial_place()
+        place.name = u'New Name'
+        self.assertEqual(place.as_dict().as_update(), {'$set': {
+            'name': u'New Name', 'key': u'new name'}})
+        self.assertEqual(place.changes()['$set'],
+                         {'name': u'New Name', 'key': u'new name'})
+
+    def test_partial_save(self):
+        place = self.partial_place()
+        self.dbc.documents[place._id] = {'_id': place._id, 'name': u'Old',
+                                         'key': u'old', 'about': u'about'}
+        place.name = u'New Name'
+
+        @gen.coroutine
+        def save():
+            yield motor.Op(Place.objects.save, place)
+        IOLoop.instance().run_sync(save)
+        self.assertEqual(self.dbc.documents[place._id], {
+            '_id': place._id, 'name': u'New Name', 'key': u'new name',
+            'about': u'about'})
+
+    def test_partial_without_source(self):
+        place = Place.create_trusted({'_id': ObjectId(), 'key': u'old'})
+        place.set_projection(['key'])
+        self.assertEqual(place.key, u'old')
+        self.assertEqual(place.as_dict().as_update(),
+                         {'$set': {'key': u'old'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from datetime import datetime
+from bson import ObjectId
+
+from collection import Collection
+from field import StringField, IntegerField, ListField, DateTimeField, \
+    EmbeddedDocumentField, ObjectIdField
+from encoder import DocumentEncoder, _default
+
+
+class Address(Collection):
+    city = StringField()
+    zip_code = StringField(name='zip')
+
+
+class Tag(Collection):
+    title = StringField(required=True)
+    weight = IntegerField(default=1)
+
+
+class Person(Collection):
+    _id = ObjectIdField()
+    name = StringField(required=True)
+    nick = StringField(name='n')
+    tags = ListField(Tag)
+    address = EmbeddedDocumentField(Address)
+    created = DateTimeField()
+
+
+class DocumentEncoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.person = Person.create({
+            '_id': ObjectId(), 'name': u'Vasia', 'nick': u'vp',
+            'tags': [{'title': u'one'}, {'title': u'two', 'weight': 5}],
+            'address': {'city': u'Kyiv'},
+            'created': datetime(2013, 5, 1, 12, 30)})
+
+    def assert_same(self, encoded, data):
+        self.assertEqual(json.loads(encoded),
+                         json.loads(json.dumps(data, default=_default)))
+
+    def test_document(self):
+        for exclude_unset in (False, True):
+            encoder = DocumentEncoder(Person, exclude_unset)
+            self.assert_same(encoder.encode(self.person),
+                             self.person.as_dict(exclude_unset))
+
+    def test_mapping(self):
+        for exclude_unset in (False, True):
+            data = self.person.as_dict(exclude_unset)
+            data['tags'][0] = {'title': u'one'}
+            encoder = DocumentEncoder(Person, exclude_unset)
+            self.assert_same(encoder.encode(data), data)
+            self.assertIn('"nick":"vp"', encoder.encode(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
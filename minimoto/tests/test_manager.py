@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import functools
+
+import motor
+
+from bson import ObjectId
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import connector
+from fakedb import FakeClient
+from collection import Collection
+from field import StringField, IntegerField, ObjectIdField, \
+    NormalizedField
+from utils import ConflictError
+
+
+class Item(Collection):
+    __db_alias__ = 'test_manager'
+    __cache__ = {'max_size': 10, 'ttl': 60}
+
+    _id = ObjectIdField()
+    name = StringField()
+
+
+class ManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        connector.connect('test', alias='test_manager',
+                          connection_class=FakeClient)
+        self.dbc = Item.objects.get_db()[Item.collection_name()]
+
+    def tearDown(self):
+        connector.disconnect('test_manager')
+        Item.objects.invalidate()
+
+    def run_sync(self, func):
+        return IOLoop.instance().run_sync(gen.coroutine(func))
+
+
+class CacheTest(ManagerTestCase):
+
+    def test_read_before_write(self):
+        _id = ObjectId()
+        self.dbc.documents[_id] = {'_id': _id, 'name': u'old'}
+        find_one = self.dbc.find_one
+
+        def slow_find_one(*args, **kwargs):
+            # result is read now, but returned after write
+            callback = kwargs.pop('callback')
+            find_one(*args, callback=lambda result, error:
+                     IOLoop.instance().add_timeout(
+                         IOLoop.instance().time() + 0.01,
+                         functools.partial(callback, result, error)),
+                     **kwargs)
+        self.dbc.find_one = slow_find_one
+
+        def read_and_write():
+            Item.objects.find_one({'_id': _id},
+                                  callback=(yield gen.Callback('read')))
+            yield motor.Op(Item.objects.update, {'_id': _id},
+                           {'$set': {'name': u'new'}})
+            item, error = (yield gen.Wait('read')).args
+            self.assertEqual(item.name, u'old')
+            item = yield motor.Op(Item.objects.find_one, {'_id': _id})
+            self.assertEqual(item.name, u'new')
+        self.run_sync(read_and_write)
+
+
+class Versioned(Collection):
+    __db_alias__ = 'test_manager'
+    __version_field__ = 'version'
+
+    _id = ObjectIdField()
+    name = StringField()
+    about = StringField()
+    version = IntegerField(default=0)
+
+
+class SaveVersionedTest(ManagerTestCase):
+
+    def setUp(self):
+        super(SaveVersionedTest, self).setUp()
+        self.dbc = Versioned.objects.get_db()[Versioned.collection_name()]
+
+    def save(self, document):
+        def save():
+            yield motor.Op(Versioned.objects.save_versioned, document)
+        self.run_sync(save)
+
+    def test_stored_without_version(self):
+        _id = ObjectId()
+        self.dbc.documents[_id] = {'_id': _id, 'name': u'a', 'about': u'b'}
+        document = Versioned.create_trusted(dict(self.dbc.documents[_id]))
+        document.name = u'c'
+        self.save(document)
+        self.assertEqual(self.dbc.documents, {_id: {
+            '_id': _id, 'name': u'c', 'about': u'b', 'version': 1}})
+        self.assertEqual(document.version, 1)
+        document.name = u'd'
+        self.save(document)
+        self.assertEqual(self.dbc.documents[_id]['version'], 2)
+
+    def test_partial_without_version(self):
+        _id = ObjectId()
+        self.dbc.documents[_id] = {'_id': _id, 'name': u'a', 'about': u'b'}
+        document = Versioned.create_trusted({'_id': _id, 'name': u'a'})
+        document.set_projection(['name', 'version'])
+        document.name = u'c'
+        self.save(document)
+        self.assertEqual(self.dbc.documents, {_id: {
+            '_id': _id, 'name': u'c', 'about': u'b', 'version': 1}})
+
+    def test_new_with_id(self):
+        document = Versioned.create({'_id': ObjectId(), 'name': u'a'})
+        self.save(document)
+        self.assertEqual(self.dbc.documents[document._id]['version'], 1)
+
+    def test_changed_without_version(self):
+        _id = ObjectId()
+        self.dbc.documents[_id] = {'_id': _id, 'name': u'a', 'version': 0}
+        document = Versioned.create_trusted(dict(self.dbc.documents[_id]))
+        self.dbc.documents[_id]['version'] = 1
+        self.assertRaises(ConflictError, self.save, document)
+
+
+class Place(Collection):
+    __db_alias__ = 'test_manager'
+
+    _id = ObjectIdField()
+    name = StringField()
+    name_key = NormalizedField('name', name='k')
+
+
+class AutocompleteTest(ManagerTestCase):
+
+    def test_renamed_shadow(self):
+        dbc = Place.objects.get_db()[Place.collection_name()]
+
+        def autocomplete():
+            for name in (u'Caf\xe9 Central', u'Cinema'):
+                yield motor.Op(Place.objects.save, Place.create({
+                    'name': name}))
+            self.assertEqual(sorted(dbc.documents.values()[0]),
+                             ['_id', 'name', 'name_key'])
+            for field in ('name', 'name_key'):
+                places = yield motor.Op(Place.objects.autocomplete, u'caf',
+                                        field)
+                self.assertEqual([x.name for x in places],
+                                 [u'Caf\xe9 Central'])
+        self.run_sync(autocomplete)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Streaming export and import of collections. Documents are written to NDJSON
+(extended JSON, one document per line) or BSON files, optionally compressed
+with gzip or bz2, and read back with bounded memory. Usage:
+
+    count = yield motor.Op(export_collection, User.objects, 'users.bson.gz')
+    result = yield motor.Op(import_collection, User.objects,
+                            'users.bson.gz', checkpoint='users.checkpoint')
+
+or from command line:
+
+    python -m minimoto.transfer export app.models.User users.ndjson.gz
+    python -m minimoto.transfer import app.models.User users.ndjson.gz \\
+        --checkpoint users.checkpoint
+
+Format and compression are detected by file name. If `checkpoint` file is
+given, progress is stored there after every batch and interrupted transfer
+is resumed from it.
+'''
+
+import os
+import bz2
+import sys
+import gzip
+import json
+import zlib
+import struct
+import logging
+import argparse
+import importlib
+
+from cStringIO import StringIO
+
+import motor
+
+from bson import BSON, json_util
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import connector
+from field import BatchValidationError
+
+
+__all__ = ['export_collection', 'import_collection', 'Checkpoint', ]
+
+NDJSON, BSON_FORMAT = 'ndjson', 'bson'
+GZIP, BZ2 = 'gzip', 'bz2'
+_SUFFIXES = {'.gz': GZIP, '.bz2': BZ2}
+# duplicate key error, e.g. batch was inserted before interruption
+DUPLICATE_KEY = 11000
+# only first errors are kept in import result
+MAX_ERRORS = 100
+
+
+def detect_format(path, format=None, compress=None):
+    '''
+    Returns format and compression of file by its name, e.g.
+    `users.bson.gz` is gzipped BSON.
+    '''
+    name, ext = os.path.splitext(path)
+    if ext in _SUFFIXES:
+        compress = compress or _SUFFIXES[ext]
+        ext = os.path.splitext(name)[1]
+    if format is None:
+        format = BSON_FORMAT if ext == '.bson' else NDJSON
+    if format not in (NDJSON, BSON_FORMAT):
+        raise ValueError('Unknown format %r' % (format,))
+    if compress not in (None, GZIP, BZ2):
+        raise ValueError('Unknown compression %r' % (compress,))
+    return format, compress
+
+
+class Checkpoint(object):
+    '''
+    Progress of transfer stored in JSON file. File is replaced atomically,
+    so it's never broken by interruption.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json_util.loads(f.read())
+
+    def save(self, **state):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json_util.dumps(state))
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _compress(data, compress):
+    '''
+    Compresses chunk as separate gzip member or bz2 stream, so file can be
+    truncated to chunk boundary on resume.
+    '''
+    if compress == GZIP:
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(data)
+        return buf.getvalue()
+    elif compress == BZ2:
+        return bz2.compress(data)
+    return data
+
+
+def _decompressor(compress):
+    if compress == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+
+def _read_chunks(path, compress, block_size=1 << 16):
+    '''
+    Yields decompressed data of file in blocks. Concatenated gzip members
+    and bz2 streams are supported.
+    '''
+    with open(path, 'rb') as f:
+        decompressor = _decompressor(compress) if compress else None
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            if decompressor is None:
+                yield block
+                continue
+            while block:
+                try:
+                    data = decompressor.decompress(block)
+                except EOFError:  # previous bz2 stream is finished
+                    decompressor = _decompressor(compress)
+                    data = decompressor.decompress(block)
+                if data:
+                    yield data
+                block = decompressor.unused_data
+                if block:  # next member or stream
+                    decompressor = _decompressor(compress)
+
+
+def _iter_ndjson(chunks):
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json_util.loads(line)
+    if tail.strip():
+        yield json_util.loads(tail)
+
+
+def _iter_bson(chunks):
+    buf, offset = '', 0
+    for chunk in chunks:
+        buf = buf[offset:] + chunk
+        offset = 0
+        while len(buf) - offset >= 4:
+            size = struct.unpack('<i', buf[offset:offset + 4])[0]
+            if len(buf) - offset < size:
+                break
+            yield BSON(buf[offset:offset + size]).decode()
+            offset += size
+    if len(buf) > offset:
+        raise ValueError('Unexpected end of BSON file')
+
+
+def read_documents(path, format=None, compress=None):
+    '''
+    Yields documents of exported file one by one.
+    '''
+    format, compress = detect_format(path, format, compress)
+    chunks = _read_chunks(path, compress)
+    if format == BSON_FORMAT:
+        return _iter_bson(chunks)
+    return _iter_ndjson(chunks)
+
+
+def _encoder(format):
+    if format == BSON_FORMAT:
+        # original bytes of `RawDocument` are written as is
+        return lambda document: getattr(document, 'raw', None) or \
+            BSON.encode(document)
+    return lambda document: json_util.dumps(
+        getattr(document, 'data', document)) + '\n'
+
+
+@gen.engine
+def export_collection(manager, path, spec=None, format=None, compress=None,
+                      batch_size=1000, checkpoint=None, callback=None):
+    '''
+    Writes documents found by `spec` to file in order of `_id`. Result is
+    total number of exported documents.
+    '''
+    stream = output = None
+    try:
+        format, compress = detect_format(path, format, compress)
+        encode = _encoder(format)
+        checkpoint = Checkpoint(checkpoint)
+        state = checkpoint.load()
+        count = state.get('count', 0)
+        if state:
+            # drop data written after last checkpoint
+            output = open(path, 'r+b')
+            output.truncate(state['offset'])
+            output.seek(state['offset'])
+            spec = {'$and': [spec or {}, {'_id': {'$gt': state['last_id']}}]}
+        else:
+            output = open(path, 'wb')
+        stream = manager.stream(spec, batch_size=batch_size, raw=True,
+                                modifier=lambda cursor: cursor.sort('_id', 1))
+        while True:
+            batch = yield motor.Op(stream.next_batch)
+            if not batch:
+                break
+            output.write(_compress(''.join(map(encode, batch)), compress))
+            output.flush()
+            count += len(batch)
+            checkpoint.save(count=count, offset=output.tell(),
+                            last_id=batch[-1]['_id'])
+        output.close()
+        checkpoint.clear()
+    except Exception, e:
+        if stream is not None:
+            stream.close()
+        if output is not None:
+            output.close()
+        if callback is not None:
+            callback(None, e)
+        return
+    if callback is not None:
+        callback(count, None)
+
+
+def _batches(documents, batch_size):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@gen.engine
+def import_collection(manager, path, format=None, compress=None,
+                      batch_size=1000, validate=True, skip_invalid=False,
+                      checkpoint=None, callback=None):
+    '''
+    Inserts documents from file with unordered bulk writes. Documents are
+    validated against collection class by batches (see
+    `Collection.create_batch`), invalid documents are skipped if
+    `skip_invalid` is set, otherwise import fails. Result is dict with
+    `count` of processed documents, `inserted`, `invalid`, `duplicates`
+    and first `errors` as (row, error) pairs.
+    '''
+    result = {'count': 0, 'inserted': 0, 'invalid': 0, 'duplicates': 0,
+              'errors': []}
+    try:
+        checkpoint = Checkpoint(checkpoint)
+        state = checkpoint.load()
+        resumed = result['count'] = state.get('count', 0)
+        documents = read_documents(path, format, compress)
+        for _ in xrange(resumed):  # already imported
+            next(documents)
+        for batch in _batches(documents, batch_size):
+            first_row = result['count']
+            processed = len(batch)
+            rows = range(first_row, first_row + processed)
+            if validate:
+                models, errors = manager.collection.create_batch(batch)
+                if errors:
+                    if not skip_invalid:
+                        raise BatchValidationError(dict(
+                            [(first_row + i, e) for i, e in errors.items()]))
+                    result['invalid'] += len(errors)
+                    _add_errors(result, [(first_row + i, e)
+                                         for i, e in sorted(errors.items())])
+                batch = [model.as_dict(exclude_unset=True)
+                         for model in models if model is not None]
+                rows = [row for row, model in zip(rows, models)
+                        if model is not None]
+            writer = manager.bulk(ordered=False, batch_size=batch_size)
+            for document in batch:
+                writer.insert(document)
+            response = yield motor.Op(writer.execute)
+            result['inserted'] += response['nInserted']
+            for index, error in response['errors']:
+                # documents inserted before interruption
+                if error.code == DUPLICATE_KEY and resumed:
+                    result['duplicates'] += 1
+                else:
+                    _add_errors(result, [(rows[index], error)])
+            result['count'] = first_row + processed
+            checkpoint.save(count=result['count'])
+        checkpoint.clear()
+    except Exception, e:
+        if callback is not None:
+            callback(None, e)
+        return
+    if callback is not None:
+        callback(result, None)
+
+
+def _add_errors(result, errors):
+    free = MAX_ERRORS - len(result['errors'])
+    if free > 0:
+        result['errors'].extend(errors[:free])
+
+
+def _load_class(path):
+    module_name, _, class_name = path.rpartition('.')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export or import collection of model class.')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('model', help='dotted path of collection class')
+    parser.add_argument('path')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--format', choices=[NDJSON, BSON_FORMAT])
+    parser.add_argument('--compress', choices=[GZIP, BZ2])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--checkpoint', help='file to store progress')
+    parser.add_argument('--spec', help='JSON query of exported documents')
+    parser.add_argument('--skip-invalid', action='store_true')
+    args = parser.parse_args(argv)
+
+    model = _load_class(args.model)
+    alias = getattr(model, '__db_alias__', None) or connector.DEFAULT_ALIAS
+    # motor client must be opened before database is taken from it
+    connection = connector.get_connection(alias=alias, host=args.host,
+                                          port=args.port)
+    connection.open_sync()
+    connector.connect(args.db, alias=alias, connection_alias=alias)
+
+    options = dict(format=args.format, compress=args.compress,
+                   batch_size=args.batch_size, checkpoint=args.checkpoint)
+    if args.action == 'export':
+        spec = json_util.loads(args.spec) if args.spec else None
+        operation = motor.Op(export_collection, model.objects, args.path,
+                             spec, **options)
+    else:
+        operation = motor.Op(import_collection, model.objects, args.path,
+                             skip_invalid=args.skip_invalid, **options)
+
+    @gen.coroutine
+    def run():
+        response = yield operation
+        raise gen.Return(response)
+
+    try:
+        result = IOLoop.instance().run_sync(run)
+    except Exception, e:
+        logging.error('%s failed: %s', args.action, e)
+        return 1
+    sys.stdout.write('%s\n' % json.dumps(result, default=str))
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    sys.exit(main())
@@ -1,5 +1,12 @@
 import re
 import math
+import time
+import base64
+import random
+import unicodedata
+
+from bson import json_util
+from tornado.ioloop import IOLoop
 
 
 class Object(object):
@@ -10,6 +17,32 @@ class RetryError(Exception):
     pass
 
 
+class ConflictError(RetryError):
+    '''
+    Raised by versioned write, if document was changed by someone else
+    since it was read.
+    '''
+
+
+class OptimisticStats(object):
+    '''
+    Counters of `optimistic_async` calls.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = self.retries = self.conflicts = self.failures = 0
+
+    def as_dict(self):
+        return {'calls': self.calls, 'retries': self.retries,
+                'conflicts': self.conflicts, 'failures': self.failures}
+
+
+optimistic_stats = OptimisticStats()
+
+
 #TODO (mkamenkov): should be `yield Optimistic(action, args, kwargs, repeats=3)`
 def optimistic(action, args=None, kwargs=None, repeats=3,
                retry_on_error=True, callback=None):
@@ -37,13 +70,70 @@ def optimistic(action, args=None, kwargs=None, repeats=3,
                 raise
 
 
+def optimistic_async(action, args=None, kwargs=None, repeats=3,
+                     retry_on_error=True, backoff=0.01, max_backoff=1.0,
+                     stats=None, io_loop=None, callback=None):
+    '''
+    Same as `optimistic`, but action is asynchronous: it gets
+    `callback(result, error)`, and errors passed to it or raised are
+    retried (`RetryError`, e.g. `ConflictError` of versioned writes, or any
+    error if `retry_on_error` is set). Retries are delayed by random time
+    up to `backoff * 2 ** attempt` seconds, but not more than `max_backoff`
+    (exponential backoff with full jitter), so concurrent writers don't
+    conflict again. Counters are collected to `stats` (`optimistic_stats`
+    by default). Usage:
+
+        result = yield motor.Op(optimistic_async, action, repeats=5)
+    '''
+    if args is None:
+        args = ()
+    if kwargs is None:
+        kwargs = {}
+    if stats is None:
+        stats = optimistic_stats
+    stats.calls += 1
+    io_loop = io_loop or IOLoop.instance()
+    attempts = [0]
+
+    def attempt():
+        attempts[0] += 1
+        finished = []
+
+        def done(result, error=None):
+            if finished:  # action called back twice or raised after it
+                return
+            finished.append(True)
+            if error is None:
+                callback(result, None)
+                return
+            if isinstance(error, ConflictError):
+                stats.conflicts += 1
+            retry = isinstance(error, RetryError) or retry_on_error
+            if not retry or attempts[0] >= repeats:
+                stats.failures += 1
+                callback(None, error)
+                return
+            stats.retries += 1
+            delay = random.uniform(
+                0, min(max_backoff, backoff * 2 ** (attempts[0] - 1)))
+            io_loop.add_timeout(time.time() + delay, attempt)
+
+        try:
+            action(*args, callback=done, **kwargs)
+        except Exception, e:
+            done(None, e)
+    attempt()
+
+
 def match_exact(query, delim=None, base='.*(%(pattern)s).*', options='i', min_length=3):
     '''
     Usage:
     >>> match_exact('Vasia Pupkin')
     {'$options': 'i', '$regex': '.*(Vasia|Pupkin).*'}
 
-    Returns `None` if bad query.
+    Returns `None` if bad query. Regex is unanchored, so it cannot use
+    index, it's fallback of `MotorManager.search` for collections without
+    text index.
     '''
     parts = set([re.escape(x) for x in query.split(delim) if len(x) >= min_length])
     if parts:
@@ -54,6 +144,49 @@ def match_exact(query, delim=None, base='.*(%(pattern)s).*', options='i', min_le
         return rspec
 
 
+def normalize_text(value):
+    '''
+    Returns lowercase text without accents and extra whitespace.
+    Usage:
+    >>> normalize_text(u' Cr\\xe8me  Br\\xfbl\\xe9e')
+    u'creme brulee'
+    '''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    value = unicodedata.normalize('NFKD', value)
+    value = u''.join([x for x in value if not unicodedata.combining(x)])
+    return u' '.join(value.lower().split())
+
+
+def match_prefix(query, min_length=1):
+    '''
+    Usage:
+    >>> match_prefix('Vasia')
+    {'$regex': u'^vasia'}
+
+    Regex is anchored and case sensitive, so it's resolved by range scan of
+    index on normalized field (see `NormalizedField`). Returns `None` if
+    bad query.
+    '''
+    prefix = normalize_text(query)
+    if prefix and len(prefix) >= min_length:
+        return {'$regex': u'^' + re.escape(prefix)}
+
+
+def text_query(text, language=None):
+    '''
+    Usage:
+    >>> text_query('coffee shop')
+    {'$text': {'$search': 'coffee shop'}}
+    '''
+    query = {'$search': text}
+    if language:
+        query['$language'] = language
+    return {'$text': query}
+
+
 def maybe_multi(value, safe=True):
     '''
     Usage:
@@ -86,6 +219,26 @@ def model_fields(include=None, exclude=None):
     return dict(exclude, **include)
 
 
+def find_projection(args, kwargs):
+    '''
+    Returns `fields` argument of `find`/`find_one` call.
+    '''
+    if len(args) > 1:
+        return args[1]
+    return kwargs.get('fields')
+
+
+def query_key(*parts):
+    '''
+    Returns hashable key for query parts (spec, fields, etc.), which doesn't
+    depend on dict keys order.
+    Usage:
+    >>> query_key({'b': 1, 'a': 2})
+    '[{"a": 2, "b": 1}]'
+    '''
+    return json_util.dumps(parts, sort_keys=True)
+
+
 def _to_list(value, delim=','):
     if not value:
         return []
@@ -99,21 +252,33 @@ def _to_list(value, delim=','):
 class Paginator(object):
     """
     An object responsible for pagination processing. Pages counting from one.
+
+    If `total_count` is `None` paginator works without counting: it fetches
+    one extra document to find out if there is next page, so found
+    documents must be passed through `page()`.
     """
-    def __init__(self, page, per_page, total_count):
+    def __init__(self, page, per_page, total_count=None):
         self.page = page
         self.per_page = per_page
         self.total_count = total_count
+        self.has_next = None
+
+    @property
+    def countless(self):
+        return self.total_count is None
 
     @property
     def page_count(self):
+        if self.countless:
+            # lower bound, that is good enough to render pages links
+            return self.current_page + (1 if self.has_next else 0)
         return int(math.ceil(float(self.total_count) / self.per_page))
 
     @property
     def current_page(self):
         if self.page <= 0:
             return 1
-        if self.page > self.page_count:
+        if not self.countless and self.page > self.page_count:
             return self.page_count
         return self.page
 
@@ -123,10 +288,14 @@ class Paginator(object):
 
     @property
     def limit(self):
+        if self.countless:
+            return self.per_page + 1
         return self.per_page
 
     @property
     def last(self):
+        if self.countless:
+            return not self.has_next
         return self.current_page == self.page_count
 
     @property
@@ -153,10 +322,153 @@ class Paginator(object):
     def paginate(self, query):
         return query.skip(self.skip).limit(self.limit)
 
+    @property
+    def cache_key(self):
+        return ('paginate', self.skip, self.limit)
+
+    def page(self, documents):
+        '''
+        Trims documents fetched in countless mode to page size.
+        '''
+        documents = list(documents)
+        if self.countless:
+            self.has_next = len(documents) > self.per_page
+            documents = documents[:self.per_page]
+        else:
+            self.has_next = self.current_page < self.page_count
+        return documents
+
     def __call__(self, query):
         return self.paginate(query)
 
 
+class KeysetPaginator(object):
+    """
+    Range based pagination. Instead of skipping documents page is selected
+    by condition on sort key values of the last (or first) document of the
+    previous page, so deep pages cost same as first one if sort key is
+    indexed. Continuation tokens are opaque for client code.
+    Usage:
+
+        pager = KeysetPaginator(20, sorter.sort_params, token=token)
+        docs = yield motor.Op(Model.objects.find, pager.spec(spec),
+                              modifier=pager)
+        docs = pager.page(docs)
+        # pager.next_token, pager.prev_token
+    """
+    NEXT = 'n'
+    PREV = 'p'
+
+    def __init__(self, per_page, sort_params=None, token=None):
+        self.per_page = per_page
+        sort_params = list(sort_params or [])
+        # `_id` is unique, so it makes any compound key unique as well
+        if '_id' not in [field for field, direction in sort_params]:
+            sort_params.append(('_id', Sorter.DIRECTION_ASC))
+        self.sort_params = sort_params
+        self.token = token
+        self.direction, self.key = self.decode_token(token)
+        self.next_token = None
+        self.prev_token = None
+
+    @property
+    def fields(self):
+        return [field for field, direction in self.sort_params]
+
+    @property
+    def limit(self):
+        # One extra document tells if there is one more page
+        return self.per_page + 1
+
+    @property
+    def first(self):
+        return self.token is None
+
+    def encode_token(self, direction, key):
+        data = json_util.dumps({'d': direction, 'k': key})
+        return base64.urlsafe_b64encode(data)
+
+    def decode_token(self, token):
+        if not token:
+            return self.NEXT, None
+        try:
+            data = json_util.loads(base64.urlsafe_b64decode(str(token)))
+            direction, key = data['d'], data['k']
+        except Exception:
+            raise ValueError('Invalid pagination token.')
+        if direction not in (self.NEXT, self.PREV) or \
+                len(key) != len(self.sort_params):
+            raise ValueError('Invalid pagination token.')
+        return direction, key
+
+    def _sort_params(self):
+        if self.direction == self.PREV:
+            return [(f, -d) for f, d in self.sort_params]
+        return self.sort_params
+
+    def spec(self, spec=None):
+        '''
+        Returns query spec extended with range condition for current page.
+        '''
+        spec = dict(spec or {})
+        if self.key is None:
+            return spec
+        # (a > x) or (a == x and b > y) or ...
+        ranges = []
+        for i, (field, direction) in enumerate(self._sort_params()):
+            cond = dict(zip(self.fields[:i], self.key[:i]))
+            op = '$gt' if direction == Sorter.DIRECTION_ASC else '$lt'
+            cond[field] = {op: self.key[i]}
+            ranges.append(cond)
+        range_spec = ranges[0] if len(ranges) == 1 else {'$or': ranges}
+        if spec:
+            return {'$and': [spec, range_spec]}
+        return range_spec
+
+    def paginate(self, query):
+        return query.sort(self._sort_params()).limit(self.limit)
+
+    @property
+    def cache_key(self):
+        return ('keyset', self._sort_params(), self.limit)
+
+    def page(self, documents):
+        '''
+        Trims fetched documents to page size, restores requested order and
+        prepares continuation tokens.
+        '''
+        documents = list(documents)
+        has_more = len(documents) > self.per_page
+        documents = documents[:self.per_page]
+        if self.direction == self.PREV:
+            documents.reverse()
+            has_next, has_prev = self.key is not None, has_more
+        else:
+            has_next, has_prev = has_more, self.key is not None
+        self.next_token = self.prev_token = None
+        if documents:
+            if has_next:
+                self.next_token = self.encode_token(
+                    self.NEXT, self.key_of(documents[-1]))
+            if has_prev:
+                self.prev_token = self.encode_token(
+                    self.PREV, self.key_of(documents[0]))
+        return documents
+
+    def key_of(self, document):
+        return [_get_path(document, field) for field in self.fields]
+
+    def __call__(self, query):
+        return self.paginate(query)
+
+
+def _get_path(document, path):
+    value = document
+    for name in path.split('.'):
+        value = value[name] if value is not None else None
+    return value
+
+
 class Sorter(object):
     """
     An object responsible for sorting params processing
@@ -192,6 +504,10 @@ class Sorter(object):
             return query.sort(sort_params)
         return query
 
+    @property
+    def cache_key(self):
+        return ('sort', list(self.sort_params))
+
     @property
     def directions(self):
         return [direction for field, direction in self.sort_params]